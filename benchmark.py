@@ -0,0 +1,139 @@
+"""
+Benchmark of the tagging pipeline on synthetic data (see `synthetic`).
+
+Each stage is timed (wall and cpu time) and its peak memory is measured (see `instrumentation`)
+for several numbers of tracks and folds. Every configuration runs in a separate process, so peak memory does not leak between them.
+Results are appended as json lines to the output file to compare versions, e.g.::
+
+    python benchmark.py --sizes 1e5 1e6 1e7 --folds 2 5 --output benchmark.jsonl
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+import multiprocessing
+
+import matplotlib
+matplotlib.use('Agg')
+import numpy
+from sklearn.ensemble import GradientBoostingClassifier
+
+import synthetic
+import instrumentation
+import utils
+from folding_group import FoldingGroupClassifier
+
+FOLD_STAGES = ['fit', 'predict']
+STAGES = ['generate', 'fit', 'predict', 'B_prob', 'calibrate_probs', 'bootstrap']
+MEAN_TRACKS = 8.
+
+
+def get_revision():
+    """
+    :return: git revision of the repository or None
+    """
+    try:
+        with open(os.devnull, 'w') as devnull:
+            revision = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=devnull,
+                                               cwd=os.path.dirname(os.path.abspath(__file__)))
+        return revision.decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _run_configuration(args):
+    n_tracks, n_folds, stages, n_estimators, seed = args
+    n_events = int(n_tracks / MEAN_TRACKS)
+    with instrumentation.Recorder() as recorder:
+        with instrumentation.stage('generate', rows=n_tracks):
+            data, probs = synthetic.generate_tracks(n_events, mean_tracks=MEAN_TRACKS, random_state=seed,
+                                                    return_true_probs=True)
+        if n_folds is not None:
+            classifier = FoldingGroupClassifier(GradientBoostingClassifier(n_estimators=n_estimators, max_depth=3),
+                                                n_folds=n_folds, random_state=seed, group_feature='event_id',
+                                                train_features=synthetic.TRACK_FEATURES)
+            if 'fit' in stages or 'predict' in stages:
+                with instrumentation.stage('fit', rows=len(data)):
+                    classifier.fit(data, data['label'].values, sample_weight=data['N_sig_sw'].values)
+            if 'predict' in stages:
+                with instrumentation.stage('predict', rows=len(data)):
+                    classifier.predict_proba(data)
+        else:
+            # stages, which do not depend on folding, use noisy true probabilities as predictions;
+            # events with negative sWeights are removed, since recent isotonic regression requires positive weights
+            probs = numpy.clip(probs + numpy.random.RandomState(seed).normal(0, 0.05, size=len(probs)), 0.01, 0.99)
+            positive = data['N_sig_sw'].values > 0
+            data, probs = data[positive], probs[positive]
+            event_index = utils.EventIndex(data['event_id'].values)
+            if 'B_prob' in stages:
+                with instrumentation.stage('B_prob', rows=len(data)):
+                    utils.compute_B_prob_using_part_prob(data, probs, event_index=event_index)
+            if 'calibrate_probs' in stages:
+                with instrumentation.stage('calibrate_probs', rows=len(data)):
+                    utils.calibrate_probs(data['label'].values, data['N_sig_sw'].values, probs, random_state=seed)
+            if 'bootstrap' in stages:
+                Bsign, Bweight, Bprob, _ = utils.compute_B_prob_using_part_prob(data, probs, event_index=event_index)
+                with instrumentation.stage('bootstrap', rows=len(Bprob)):
+                    utils.bootstrap_calibrate_prob(Bsign, Bweight, Bprob, n_calibrations=10, symmetrize=True,
+                                                   random_state=seed)
+    records = recorder.to_dataframe()
+    records['n_tracks'], records['n_events'], records['n_folds'] = n_tracks, n_events, n_folds
+    # json-compatible records
+    return [{key: (None if isinstance(value, float) and numpy.isnan(value) else
+                   value.item() if hasattr(value, 'item') else value) for key, value in record.items()}
+            for record in records.to_dict(orient='records')]
+
+
+def run_benchmark(sizes, folds, stages=STAGES, n_estimators=20, seed=42):
+    """
+    :param sizes: numbers of tracks
+    :param folds: numbers of folds for FoldingGroupClassifier stages
+    :param stages: stages to benchmark
+    :param n_estimators: number of trees of base estimator
+    :return: list of records (dicts), one per stage and configuration
+    """
+    configurations = []
+    for n_tracks in sizes:
+        if any(stage in FOLD_STAGES for stage in stages):
+            configurations += [(n_tracks, n_folds, stages, n_estimators, seed) for n_folds in folds]
+        if any(stage not in FOLD_STAGES + ['generate'] for stage in stages):
+            configurations.append((n_tracks, None, stages, n_estimators, seed))
+    description = {'revision': get_revision(), 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                   'python': platform.python_version(), 'numpy': numpy.__version__}
+    records = []
+    for configuration in configurations:
+        # a new process for each configuration to measure its peak memory
+        pool = multiprocessing.Pool(processes=1, maxtasksperchild=1)
+        try:
+            for record in pool.apply(_run_configuration, (configuration,)):
+                record.update(description)
+                records.append(record)
+                print(json.dumps(record, sort_keys=True))
+                sys.stdout.flush()
+        finally:
+            pool.close()
+            pool.join()
+    return records
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the tagging pipeline on synthetic data')
+    parser.add_argument('--sizes', type=float, nargs='+', default=[1e5, 1e6], help='numbers of tracks')
+    parser.add_argument('--folds', type=int, nargs='+', default=[2], help='numbers of folds')
+    parser.add_argument('--stages', nargs='+', default=STAGES, choices=STAGES)
+    parser.add_argument('--n-estimators', type=int, default=20, help='number of trees of base estimator')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', default='benchmark.jsonl', help='json lines file, results are appended')
+    args = parser.parse_args()
+    records = run_benchmark([int(size) for size in args.sizes], args.folds, stages=args.stages,
+                            n_estimators=args.n_estimators, seed=args.seed)
+    with open(args.output, 'a') as output:
+        for record in records:
+            output.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+"""
+Columnar on-disk cache for the tracks table.
+
+The tab-separated `Tracks.csv` is parsed only once and stored as one `.npy` file per column,
+which later sessions open memory-mapped and read only the requested columns.
+Event ids are stored as a packed 64-bit integer key (run, event) instead of strings `run_event`.
+"""
+import os
+import json
+from collections import OrderedDict
+
+import numpy
+import pandas
+
+EVENT_BITS = 32
+META_FILE = 'meta.json'
+
+
+def pack_event_id(run, event):
+    """
+    Pack (run, event) into one int64 key: run in the upper bits, event number in the lower `EVENT_BITS` bits.
+
+    :param run: array-like of run numbers
+    :param event: array-like of event numbers
+    :return: numpy.array of int64
+    """
+    run = numpy.asarray(run).astype(numpy.int64)
+    event = numpy.asarray(event).astype(numpy.int64)
+    assert numpy.all((event >= 0) & (event < 2 ** EVENT_BITS)), 'event number does not fit in {} bits'.format(EVENT_BITS)
+    assert numpy.all((run >= 0) & (run < 2 ** (63 - EVENT_BITS))), 'run number does not fit in the packed key'
+    return (run << EVENT_BITS) | event
+
+
+def unpack_event_id(event_id):
+    """
+    Inverse of :func:`pack_event_id`.
+
+    :return: run, event arrays
+    """
+    event_id = numpy.asarray(event_id, dtype=numpy.int64)
+    return event_id >> EVENT_BITS, event_id & (2 ** EVENT_BITS - 1)
+
+
+def parse_event_id(ids):
+    """
+    Convert string event ids `run_event` (or pandas.Categorical of them) to packed int64 keys.
+
+    :return: numpy.array of int64
+    """
+    if isinstance(ids, pandas.Series):
+        ids = ids.values
+    if isinstance(ids, pandas.Categorical):
+        # parse only categories, then take them by codes
+        return parse_event_id(numpy.asarray(ids.categories))[ids.codes]
+    parts = pandas.Series(numpy.asarray(ids)).str.split('_', n=1, expand=True)
+    return pack_event_id(parts[0].astype(numpy.int64).values, parts[1].astype(numpy.int64).values)
+
+
+def compact(data, event_id_column='event_id'):
+    """
+    Compact copy of tracks table: float64 columns are converted to float32,
+    string (or categorical) event ids `run_event` are converted to packed int64 keys.
+
+    :param data: pandas.DataFrame
+    :param event_id_column: column with event id, None to keep all non-float columns as they are
+    :return: pandas.DataFrame
+    """
+    columns = OrderedDict()
+    for column in data.columns:
+        values = data[column]
+        if values.dtype == numpy.float64:
+            columns[column] = values.values.astype(numpy.float32)
+        elif column == event_id_column and values.dtype.kind not in 'iu':
+            columns[column] = parse_event_id(values.values)
+        else:
+            columns[column] = values.values
+    return pandas.DataFrame(columns, index=data.index)
+
+
+def _default_cache_dir(csv_path):
+    return csv_path + '.cache'
+
+
+def _source_stamp(csv_path):
+    stat = os.stat(csv_path)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def _read_meta(cache_dir):
+    meta_path = os.path.join(cache_dir, META_FILE)
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as meta_file:
+        return json.load(meta_file, object_pairs_hook=OrderedDict)
+
+
+def build_cache(csv_path, cache_dir=None, sep='\t', event_id_column='event_id'):
+    """
+    Parse csv once and store every column as a separate `.npy` file together with packed event id column.
+
+    :param csv_path: path to the csv file with tracks
+    :param cache_dir: directory for the cache, by default `csv_path + '.cache'`
+    :param sep: csv separator
+    :param event_id_column: name of the packed (run, event) column, None to skip it
+    :return: cache directory
+    """
+    cache_dir = cache_dir or _default_cache_dir(csv_path)
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    data = pandas.read_csv(csv_path, sep=sep)
+    if event_id_column is not None:
+        data[event_id_column] = pack_event_id(data['run'].values, data['event'].values)
+
+    columns = OrderedDict()
+    for column in data.columns:
+        values = data[column].values
+        numpy.save(os.path.join(cache_dir, column + '.npy'), values)
+        columns[column] = values.dtype.str if values.dtype != object else 'object'
+
+    meta = OrderedDict([('source', _source_stamp(csv_path)), ('length', len(data)), ('columns', columns)])
+    # meta is written last, so interrupted conversion is never treated as a valid cache
+    with open(os.path.join(cache_dir, META_FILE), 'w') as meta_file:
+        json.dump(meta, meta_file)
+    return cache_dir
+
+
+def get_cache(csv_path, cache_dir=None, sep='\t', event_id_column='event_id'):
+    """
+    Return cache directory and its description, (re)building cache if it is absent or csv was modified.
+    """
+    cache_dir = cache_dir or _default_cache_dir(csv_path)
+    meta = _read_meta(cache_dir)
+    if meta is None or (os.path.exists(csv_path) and meta['source'] != _source_stamp(csv_path)):
+        build_cache(csv_path, cache_dir=cache_dir, sep=sep, event_id_column=event_id_column)
+        meta = _read_meta(cache_dir)
+    return cache_dir, meta
+
+
+def load_columns(csv_path, columns=None, cache_dir=None, sep='\t', event_id_column='event_id'):
+    """
+    Load columns from the cache without copying: numeric columns are returned as read-only memory-mapped arrays.
+
+    :param csv_path: path to the csv file with tracks
+    :param columns: list of columns to load, None for all columns
+    :return: OrderedDict {column: numpy.array}
+    """
+    cache_dir, meta = get_cache(csv_path, cache_dir=cache_dir, sep=sep, event_id_column=event_id_column)
+    if columns is None:
+        columns = list(meta['columns'].keys())
+    result = OrderedDict()
+    for column in columns:
+        assert column in meta['columns'], 'column {} is not in {}'.format(column, csv_path)
+        path = os.path.join(cache_dir, column + '.npy')
+        if meta['columns'][column] == 'object':
+            result[column] = numpy.load(path, allow_pickle=True)
+        else:
+            result[column] = numpy.load(path, mmap_mode='r')
+    return result
+
+
+def load_tracks(csv_path='datasets/Tracks.csv', columns=None, cache_dir=None, sep='\t', event_id_column='event_id',
+                compact_floats=False):
+    """
+    Load tracks table from the columnar cache (the cache is created on the first call).
+    Only requested columns are read from disk.
+
+    :param csv_path: path to the csv file with tracks
+    :param columns: list of columns to load, None for all columns
+    :param event_id_column: name of the packed int64 (run, event) column
+    :param compact_floats: convert float64 columns to float32 (half of memory), see `compact`
+    :return: pandas.DataFrame
+    """
+    data = pandas.DataFrame(load_columns(csv_path, columns=columns, cache_dir=cache_dir, sep=sep,
+                                         event_id_column=event_id_column))
+    return compact(data, event_id_column=event_id_column) if compact_floats else data
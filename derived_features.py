@@ -0,0 +1,233 @@
+"""
+Declarative pipeline of derived features for tracks.
+
+A pipeline is a list of steps:
+
+* `group(name, function, column)` - per-event statistic ('max', 'min', 'sum', 'mean') of a column,
+  broadcast back to each track; consecutive group steps are computed in one segmented pass,
+* `expression(name, expression)` - elementwise expression of columns, evaluated with numexpr
+  (fused, without temporary arrays) if it is installed and with numpy otherwise.
+
+Columns with names starting with '_' are intermediate and are not returned.
+As in the notebooks, features are computed only for rows without NaN (after `dropna`), so per-event statistics
+do not include dropped tracks; dropped rows get NaN features.
+Computed columns are cached next to the columnar tracks cache (see `data_cache`), keyed by the pipeline and row filter.
+"""
+import os
+import re
+import json
+import hashlib
+from collections import OrderedDict
+from itertools import combinations
+
+import numpy
+import pandas
+
+import data_cache
+from utils import EventIndex
+
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
+GROUP_FUNCTIONS = {'max': numpy.maximum, 'min': numpy.minimum, 'sum': numpy.add, 'mean': numpy.add}
+# functions available in expressions when numexpr is not installed (the same names as in numexpr)
+NUMPY_FUNCTIONS = {name: getattr(numpy, name) for name in
+                   ['where', 'sin', 'cos', 'tan', 'arcsin', 'arccos', 'arctan', 'arctan2', 'sinh', 'cosh', 'tanh',
+                    'exp', 'log', 'log10', 'log1p', 'sqrt', 'abs']}
+CACHE_SUBDIR = 'derived'
+
+
+def group(name, function, column):
+    """
+    Step of pipeline: per-event statistic of column for each track.
+
+    :param function: 'max', 'min', 'sum' or 'mean'
+    """
+    assert function in GROUP_FUNCTIONS, 'unknown group function {}'.format(function)
+    return 'group', name, function, column
+
+
+def expression(name, expression):
+    """
+    Step of pipeline: elementwise expression of columns, e.g. 'cos(diff_phi)'.
+    """
+    return 'expression', name, expression
+
+
+def _pid_pair_steps():
+    steps = []
+    # the same pairs as in notebooks (iteration order of python 2 dict {'k', 'e', 'mu'}):
+    # (mu, k), (mu, e), (k, e)
+    PIDs = OrderedDict([('mu', 'PIDNNm'), ('k', 'PIDNNk'), ('e', 'PIDNNe')])
+    for (pid_name1, column1), (pid_name2, column2) in combinations(PIDs.items(), 2):
+        steps.append(expression('max_PID_{}_{}'.format(pid_name1, pid_name2),
+                                'where({0} > {1}, {0}, {1})'.format(column1, column2)))
+        steps.append(expression('sum_PID_{}_{}'.format(pid_name1, pid_name2), '{} + {}'.format(column1, column2)))
+    return steps
+
+
+# features added in the track-based tagging notebooks
+TRACK_FEATURES = [group('_max_pt', 'max', 'partPt'),
+                  expression('diff_pt', '_max_pt - partPt'),
+                  expression('cos_diff_phi', 'cos(diff_phi)')] + _pid_pair_steps()
+
+
+def _names(text):
+    return set(re.findall(r'[A-Za-z_]\w*', text))
+
+
+def get_required_columns(pipeline):
+    """
+    :return: list of raw columns used by the pipeline
+    """
+    derived, required = set(), set()
+    for step in pipeline:
+        if step[0] == 'group':
+            used = {step[3]}
+        else:
+            used = _names(step[2]) - set(NUMPY_FUNCTIONS)
+        required |= used - derived
+        derived.add(step[1])
+    return sorted(required)
+
+
+def _evaluate(text, columns):
+    local_dict = {name: columns[name] for name in _names(text) if name in columns}
+    if numexpr is not None:
+        return numexpr.evaluate(text, local_dict=local_dict)
+    namespace = dict(NUMPY_FUNCTIONS)
+    namespace.update(local_dict)
+    return eval(text, {'__builtins__': {}}, namespace)
+
+
+def _compute_groups(steps, columns, event_index):
+    # one segmented pass for all steps with the same reduction
+    for function in set(step[2] for step in steps):
+        same_steps = [step for step in steps if step[2] == function]
+        result = event_index.reduce([columns[step[3]] for step in same_steps], GROUP_FUNCTIONS[function])
+        if function == 'mean':
+            result /= event_index.counts[:, numpy.newaxis]
+        for i, step in enumerate(same_steps):
+            columns[step[1]] = result[event_index.inverse, i]
+
+
+def compute_features(data, pipeline=TRACK_FEATURES, event_id_column='event_id', event_index=None, mask=None):
+    """
+    Compute derived features.
+
+    :param data: pandas.DataFrame or dict {column: numpy.array} with raw columns
+    :param pipeline: list of steps, see `group` and `expression`
+    :param event_id_column: column with event id, used by group steps
+    :param event_index: precomputed EventIndex for event id column (of rows selected by mask), optional
+    :param mask: boolean numpy.array of shape [n_samples], only these rows are used
+        (also in per-event statistics), other rows get NaN; None means all rows
+    :return: OrderedDict {name: numpy.array} with derived columns
+    """
+    if mask is not None:
+        mask = numpy.asarray(mask, dtype=bool)
+        selected = {name: numpy.asarray(data[name])[mask] for name in _required_with_id(pipeline, event_id_column)}
+        features = compute_features(selected, pipeline, event_id_column=event_id_column, event_index=event_index)
+        for name, values in features.items():
+            full = numpy.empty(len(mask), dtype=numpy.result_type(values.dtype, numpy.float32))
+            full[~mask] = numpy.nan
+            full[mask] = values
+            features[name] = full
+        return features
+    columns = {name: numpy.asarray(data[name]) for name in get_required_columns(pipeline)}
+    pending_groups = []
+    for step in pipeline:
+        if step[0] == 'group':
+            pending_groups.append(step)
+            continue
+        if len(pending_groups) > 0:
+            if event_index is None:
+                event_index = EventIndex(numpy.asarray(data[event_id_column]))
+            _compute_groups(pending_groups, columns, event_index)
+            pending_groups = []
+        columns[step[1]] = _evaluate(step[2], columns)
+    if len(pending_groups) > 0:
+        if event_index is None:
+            event_index = EventIndex(numpy.asarray(data[event_id_column]))
+        _compute_groups(pending_groups, columns, event_index)
+    return OrderedDict((step[1], columns[step[1]]) for step in pipeline if not step[1].startswith('_'))
+
+
+def _required_with_id(pipeline, event_id_column):
+    columns = get_required_columns(pipeline)
+    if any(step[0] == 'group' for step in pipeline) and event_id_column not in columns:
+        columns.append(event_id_column)
+    return columns
+
+
+def get_complete_rows(columns):
+    """
+    :param columns: dict {column: numpy.array}
+    :return: boolean mask of rows without NaN in all columns (the rows kept by `pandas.DataFrame.dropna`)
+    """
+    mask = None
+    for values in columns.values():
+        values = numpy.asarray(values)
+        if values.dtype.kind == 'f':
+            missing = numpy.isnan(values)
+        elif values.dtype == object:
+            missing = pandas.isnull(values)
+        else:
+            continue
+        mask = ~missing if mask is None else mask & ~missing
+    if mask is None:
+        mask = numpy.ones(len(next(iter(columns.values()))), dtype=bool)
+    return mask
+
+
+def get_pipeline_key(pipeline, event_id_column='event_id', dropna=True):
+    """
+    :return: hash of pipeline definition and of row filter
+    """
+    description = [list(step) for step in pipeline] + [event_id_column, 'dropna' if dropna else 'all rows']
+    return hashlib.sha1(json.dumps(description).encode('utf-8')).hexdigest()
+
+
+def load_features(csv_path='datasets/Tracks.csv', pipeline=TRACK_FEATURES, cache_dir=None, sep='\t',
+                  event_id_column='event_id', dropna=True):
+    """
+    Load derived features of tracks, computing them on the first call.
+    Features are stored in the tracks cache directory (one `.npy` file per column) and are recomputed
+    when the csv is modified.
+
+    :param csv_path: path to the csv file with tracks
+    :param pipeline: list of steps, see `group` and `expression`
+    :param event_id_column: name of the packed int64 (run, event) column
+    :param dropna: compute features only for rows without NaN in all columns of csv, as notebooks do
+        after `data_nan.dropna()`; other rows get NaN features, so the same rows are dropped
+        from the table of tracks joined with features
+    :return: pandas.DataFrame with derived columns for all rows of csv
+    """
+    cache_dir, meta = data_cache.get_cache(csv_path, cache_dir=cache_dir, sep=sep, event_id_column=event_id_column)
+    features_dir = os.path.join(cache_dir, CACHE_SUBDIR, get_pipeline_key(pipeline, event_id_column, dropna=dropna))
+    meta_path = os.path.join(features_dir, data_cache.META_FILE)
+    names = [step[1] for step in pipeline if not step[1].startswith('_')]
+    if os.path.exists(meta_path):
+        with open(meta_path) as meta_file:
+            features_meta = json.load(meta_file)
+        if features_meta['source'] == meta['source']:
+            return pandas.DataFrame(OrderedDict((name, numpy.load(os.path.join(features_dir, name + '.npy'),
+                                                                  mmap_mode='r')) for name in names))
+
+    mask = None
+    if dropna:
+        mask = get_complete_rows(data_cache.load_columns(csv_path, cache_dir=cache_dir, sep=sep,
+                                                         event_id_column=event_id_column))
+    data = data_cache.load_columns(csv_path, columns=_required_with_id(pipeline, event_id_column), cache_dir=cache_dir,
+                                   sep=sep, event_id_column=event_id_column)
+    features = compute_features(data, pipeline, event_id_column=event_id_column, mask=mask)
+    if not os.path.exists(features_dir):
+        os.makedirs(features_dir)
+    for name, values in features.items():
+        numpy.save(os.path.join(features_dir, name + '.npy'), values)
+    # meta is written last, so interrupted computation is never treated as a valid cache
+    with open(meta_path, 'w') as meta_file:
+        json.dump({'source': meta['source'], 'pipeline': [list(step) for step in pipeline], 'dropna': dropna},
+                  meta_file)
+    return pandas.DataFrame(features)
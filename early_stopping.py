@@ -0,0 +1,237 @@
+"""
+Early stopping of boosted estimators by a weighted metric on the held-out part of a fold.
+
+Estimators with `warm_start` and `n_estimators` parameters (e.g. sklearn GradientBoostingClassifier)
+are grown by `step` stages and training stops when the metric did not improve for `rounds` stages.
+For binary sklearn gradient boosting the held-out decision function is updated only with new stages,
+so evaluation costs the same as one prediction of the final ensemble.
+Other estimators are trained completely and the best stage is found with one pass of staged predictions.
+
+After training the estimator is truncated to the best stage: sklearn boostings (`estimators_`) and
+hep_ml boostings (`estimators` list, e.g. DecisionTrainClassifier), also inside rep `SklearnClassifier`.
+Estimators without local stages (e.g. MatrixNet) are wrapped in `StageLimitedClassifier`.
+"""
+import time
+import traceback
+
+import numpy
+from scipy.special import expit
+
+from weighted_roc import WeightedRoc
+
+# metric name: sign, so that larger value of sign * metric is better
+METRICS = {'auc': 1., 'log_loss': -1.}
+
+
+def metric_value(proba, positive, sample_weight, metric='auc'):
+    """
+    :param proba: probability of positive class, numpy.array of shape [n_samples]
+    :param positive: boolean numpy.array of shape [n_samples], true for samples of positive class
+    :param sample_weight: numpy.array of shape [n_samples]
+    :param str metric: 'auc' or 'log_loss'
+    """
+    if metric == 'auc':
+        return WeightedRoc(positive, proba).auc(sample_weight)
+    return numpy.average(log_losses(proba, positive), weights=sample_weight)
+
+
+def log_losses(proba, positive):
+    """
+    :return: log-loss of each sample, numpy.array of shape [n_samples]
+    """
+    true_proba = numpy.where(positive, proba, 1 - proba)
+    return -numpy.log(numpy.clip(true_proba, 1e-15, 1.))
+
+
+def _stages_holder(estimator):
+    """
+    :return: (boosting with stages, name of stages attribute) or (None, None),
+        rep wrappers (e.g. `SklearnClassifier`) keep the boosting in `clf`
+    """
+    while estimator is not None:
+        if hasattr(estimator, 'n_estimators'):
+            if hasattr(estimator, 'estimators_'):
+                return estimator, 'estimators_'
+            # hep_ml boostings keep the list of trees in `estimators`
+            if isinstance(getattr(estimator, 'estimators', None), list):
+                return estimator, 'estimators'
+        estimator = getattr(estimator, 'clf', None)
+    return None, None
+
+
+def truncate_stages(estimator, n_stages):
+    """
+    Leave only first `n_stages` stages of a sklearn-like boosting (with `estimators_` array)
+    or a hep_ml boosting (with `estimators` list), also wrapped in a rep estimator.
+
+    :return: True if estimator was truncated
+    """
+    estimator, stages_attribute = _stages_holder(estimator)
+    if estimator is None:
+        return False
+    setattr(estimator, stages_attribute, getattr(estimator, stages_attribute)[:n_stages])
+    for attribute in ['train_score_', 'oob_improvement_', 'estimator_weights_', 'estimator_errors_']:
+        if hasattr(estimator, attribute):
+            setattr(estimator, attribute, getattr(estimator, attribute)[:n_stages])
+    estimator.n_estimators = n_stages
+    if hasattr(estimator, 'n_estimators_'):
+        estimator.n_estimators_ = n_stages
+    return True
+
+
+class StageLimitedClassifier(object):
+    """
+    Fitted classifier predicting with its first `n_stages` stages (items of `staged_predict_proba`),
+    used for estimators which can not be truncated (e.g. MatrixNet trained remotely).
+    Other attributes are taken from the wrapped classifier.
+
+    :param estimator: fitted classifier with `staged_predict_proba`
+    :param int n_stages: number of stages used for prediction
+    """
+    def __init__(self, estimator, n_stages):
+        self.estimator = estimator
+        self.n_stages = n_stages
+
+    def __getattr__(self, name):
+        # special and own attributes are not delegated (e.g. while unpickling)
+        if name.startswith('__') or name in ['estimator', 'n_stages']:
+            raise AttributeError(name)
+        return getattr(self.estimator, name)
+
+    def staged_predict_proba(self, X):
+        for stage, proba in enumerate(self.estimator.staged_predict_proba(X), 1):
+            yield proba
+            if stage >= self.n_stages:
+                break
+
+    def predict_proba(self, X):
+        proba = None
+        for proba in self.staged_predict_proba(X):
+            pass
+        return proba
+
+    def predict(self, X):
+        return self.classes_[numpy.argmax(self.predict_proba(X), axis=1)]
+
+
+def limit_stages(estimator, n_stages):
+    """
+    Truncate fitted estimator to first `n_stages` stages or wrap it in `StageLimitedClassifier`.
+
+    :return: estimator predicting with first `n_stages` stages
+    :raise ValueError: if estimator has neither stages to truncate nor staged predictions
+    """
+    if truncate_stages(estimator, n_stages):
+        return estimator
+    if not hasattr(estimator, 'staged_predict_proba'):
+        raise ValueError('estimator {} can not be truncated to {} stages'.format(type(estimator).__name__, n_stages))
+    return StageLimitedClassifier(estimator, n_stages)
+
+
+def _positive_proba(proba):
+    return proba[:, -1] / numpy.sum(proba, axis=1)
+
+
+def _fit(estimator, X, y, sample_weight):
+    if sample_weight is None:
+        estimator.fit(X, y)
+    else:
+        estimator.fit(X, y, sample_weight=sample_weight)
+
+
+def _is_binary_gradient_boosting(estimator):
+    stages = getattr(estimator, 'estimators_', None)
+    return getattr(stages, 'ndim', 0) == 2 and stages.shape[1] == 1 and hasattr(estimator, 'learning_rate') and \
+        hasattr(estimator, 'decision_function')
+
+
+class _HeldOutProba(object):
+    """
+    Probability of positive class on held-out data for an estimator grown with warm start.
+    Decision function of binary gradient boosting is kept and only contributions of new stages are added,
+    other estimators predict the held-out data with the whole ensemble.
+    """
+    def __init__(self, X_held):
+        self.X_held = X_held
+        self.decision = None
+        self.n_stages = 0
+
+    def __call__(self, estimator):
+        if not _is_binary_gradient_boosting(estimator):
+            return _positive_proba(estimator.predict_proba(self.X_held))
+        stages = estimator.estimators_
+        if self.decision is None:
+            self.decision = numpy.ravel(estimator.decision_function(self.X_held)).astype(numpy.float64)
+            # trees of gradient boosting are fitted and applied on float32
+            self.X_held = numpy.asarray(self.X_held, dtype=numpy.float32)
+        else:
+            for stage in range(self.n_stages, len(stages)):
+                self.decision += estimator.learning_rate * stages[stage, 0].predict(self.X_held)
+        self.n_stages = len(stages)
+        return expit(2 * self.decision if estimator.get_params().get('loss') == 'exponential' else self.decision)
+
+
+def _fit_with_warm_start(estimator, X, y, sample_weight, X_held, positive_held, weight_held, rounds, step, metric):
+    sign = METRICS[metric]
+    max_stages = estimator.get_params()['n_estimators']
+    estimator.set_params(warm_start=True)
+    held_out_proba = _HeldOutProba(X_held)
+    best_value, best_stage, n_stages = None, 0, 0
+    while n_stages < max_stages:
+        n_stages = min(n_stages + step, max_stages)
+        estimator.set_params(n_estimators=n_stages)
+        _fit(estimator, X, y, sample_weight)
+        value = sign * metric_value(held_out_proba(estimator), positive_held, weight_held, metric)
+        if best_value is None or value > best_value:
+            best_value, best_stage = value, n_stages
+        elif n_stages - best_stage >= rounds:
+            break
+    estimator.set_params(warm_start=False)
+    return best_stage
+
+
+def _fit_and_scan(estimator, X, y, sample_weight, X_held, positive_held, weight_held, rounds, step, metric):
+    sign = METRICS[metric]
+    _fit(estimator, X, y, sample_weight)
+    best_value, best_stage = None, 0
+    for stage, proba in enumerate(estimator.staged_predict_proba(X_held), 1):
+        if stage % step != 0:
+            continue
+        value = sign * metric_value(_positive_proba(proba), positive_held, weight_held, metric)
+        if best_value is None or value > best_value:
+            best_value, best_stage = value, stage
+        elif stage - best_stage >= rounds:
+            break
+    return best_stage
+
+
+def train_estimator_with_early_stopping(name, estimator, X, y, sample_weight, X_held, y_held, weight_held,
+                                        positive_class=1, rounds=100, step=10, metric='auc'):
+    """
+    Train estimator and choose the number of stages by metric on held-out data,
+    the same interface as `rep.metaml.factory.train_estimator`.
+
+    :param X_held: pandas.DataFrame, held-out part of the fold
+    :param y_held: labels of held-out samples
+    :param weight_held: weights of held-out samples or None
+    :param positive_class: label of positive class
+    :param int rounds: stop, if metric did not improve for this number of stages
+    :param int step: metric is computed every `step` stages
+    :param str metric: 'auc' or 'log_loss'
+    :return: ('success', (name, estimator, spent_time, best_stage)) or ('fail', traceback),
+        estimator predicts with `best_stage` stages (see `limit_stages`)
+    """
+    try:
+        start = time.time()
+        positive_held = numpy.asarray(y_held) == positive_class
+        weight_held = numpy.ones(len(positive_held)) if weight_held is None else weight_held
+        arguments = (estimator, X, y, sample_weight, X_held, positive_held, weight_held, rounds, step, metric)
+        params = estimator.get_params() if hasattr(estimator, 'get_params') else {}
+        if 'warm_start' in params and 'n_estimators' in params:
+            best_stage = _fit_with_warm_start(*arguments)
+        else:
+            best_stage = _fit_and_scan(*arguments)
+        estimator = limit_stages(estimator, best_stage)
+        return 'success', (name, estimator, time.time() - start, best_stage)
+    except Exception:
+        return 'fail', traceback.format_exc()
@@ -1,8 +1,8 @@
 from rep.estimators import Classifier
+import hashlib
 import numpy
 from sklearn.base import clone
 from rep.estimators.utils import check_inputs, _get_features
-from six.moves import zip
 from sklearn.cross_validation import KFold
 from sklearn.utils.validation import check_random_state
 from rep.metaml.factory import train_estimator
@@ -10,18 +10,78 @@ import pandas
 from rep.metaml.utils import map_on_cluster
 from rep.metaml.utils import get_classifier_probabilities, get_classifier_staged_proba, get_regressor_prediction, \
     get_regressor_staged_predict
+import local_pool
+import model_cache
+import early_stopping
+import instrumentation
+import data_cache
+import numbers
+from collections import OrderedDict
+import threading
+from multiprocessing.pool import ThreadPool
 
 
 __author__ = 'Tatiana Likhomanenko'
 
+# vote functions, which are computed as running sum over folds
+STREAMING_VOTES = ('mean', 'sum')
+
+
+def _column_fingerprint(column):
+    """
+    Cheap fingerprint of a column: length, dtype and hash of the content.
+    """
+    column = numpy.asarray(column)
+    if column.dtype == object:
+        content = hash(tuple(column))
+    else:
+        content = hashlib.sha1(numpy.ascontiguousarray(column).view(numpy.uint8)).hexdigest()
+    return len(column), column.dtype.str, content
+
+
 class FoldingGroupClassifier(Classifier):
+    """
+    Folding classifier, which keeps all samples of the same group (event) in the same fold.
+
+    :param base_estimator: classifier, which will be trained on each fold
+    :param int n_folds: number of folds
+    :param random_state: random state for folds splitting
+    :param train_features: features used in training
+    :param parallel_profile: profile for parallel training, see `rep.metaml.utils.map_on_cluster`;
+        'processes-N' trains folds in N local processes on data put once in shared memory (see `local_pool`)
+    :param str group_feature: column with group id; either string ids or packed int64 event keys
+        (see `data_cache.pack_event_id`), integer keys are much faster to group
+    :param n_threads: number of threads to predict folds concurrently, None means one thread per fold
+    :param str cache_dir: directory to cache trained folds (see `model_cache`), None to always train;
+        models are cached only if random_state is integer
+    :param int cache_size: maximal size of the cache in bytes, least recently used models are removed
+    :param early_stopping_rounds: if not None, number of stages of boosted base estimator is chosen
+        by the metric on the held-out part of each fold: training stops when the metric
+        did not improve for this number of stages (see `early_stopping`)
+    :param int early_stopping_step: the held-out metric is computed every `early_stopping_step` stages
+    :param str early_stopping_metric: 'auc' or 'log_loss'
+    :param bool compact: keep float features as float32 (float64 columns are converted) and convert
+        string group ids `run_event` to packed int64 keys; halves memory of feature matrices
+        (and of shared memory with 'processes-N' profile), folds differ from non-compact mode
+        if group ids are strings
+    """
     def __init__(self,
                  base_estimator,
                  n_folds=2,
                  random_state=None,
                  train_features=None,
-                 parallel_profile=None, group_feature=None):
+                 parallel_profile=None, group_feature=None, n_threads=None,
+                 cache_dir=None, cache_size=10 * 2 ** 30,
+                 early_stopping_rounds=None, early_stopping_step=10, early_stopping_metric='auc',
+                 compact=False):
         self.group_feature = group_feature
+        self.compact = compact
+        self.n_threads = n_threads
+        self.cache_dir = cache_dir
+        self.cache_size = cache_size
+        self.early_stopping_rounds = early_stopping_rounds
+        self.early_stopping_step = early_stopping_step
+        self.early_stopping_metric = early_stopping_metric
         self.train_features = train_features
         self.estimators = []
         self.parallel_profile = parallel_profile
@@ -30,6 +90,8 @@ class FoldingGroupClassifier(Classifier):
         self._folds_indices = None
         self.random_state = random_state
         self._random_number = None
+        self._folds_cache = None
+        self._train_groups = None
         # setting features directly
         Classifier.__init__(self, features=self._features())
 
@@ -52,33 +114,63 @@ class FoldingGroupClassifier(Classifier):
         if self.group_feature is not None:
             group_column_values, _ = _get_features([self.group_feature], X, allow_nans=allow_nans)
             group_column_values = numpy.ravel(numpy.array(group_column_values))
+            if self.compact and group_column_values.dtype.kind not in 'iu':
+                group_column_values = data_cache.parse_event_id(group_column_values)
         if self.train_features is None:
             train_features = list(set(X.columns) - {self.group_feature})
         else:
             train_features = self.train_features
         X_prepared, self.train_features = _get_features(train_features, X, allow_nans=allow_nans)
+        if self.compact:
+            X_prepared = data_cache.compact(X_prepared, event_id_column=None)
         self.features = self._features()
         return group_column_values, X_prepared
 
     def _get_folds_column(self, length, group_column=None):
         """
         Return special column with indices of folds for all events.
+        The last result is memoized, so repeated predictions on the same data do not recompute it.
         """
         if self._random_number is None:
             self._random_number = check_random_state(self.random_state).randint(0, 100000)
-        folds_column = numpy.zeros(length)
         if group_column is not None:
             assert len(group_column) == length, 'id column should have the same lenght as train'
-            ids = numpy.unique(group_column)
+            key = (_column_fingerprint(group_column), self._random_number, self.n_folds)
+        else:
+            key = (length, self._random_number, self.n_folds)
+        if self._folds_cache is not None and self._folds_cache[0] == key:
+            return self._folds_cache[1]
+
+        folds_column = numpy.zeros(length)
+        groups_folds = None
+        if group_column is not None:
+            ids, ids_inverse = numpy.unique(group_column, return_inverse=True)
+            ids_folds = numpy.zeros(len(ids))
             for fold_number, (_, folds_indices) in enumerate(
                     KFold(len(ids), self.n_folds, shuffle=True, random_state=self._random_number)):
-                folds_column[numpy.in1d(group_column, ids[folds_indices])] = fold_number
+                ids_folds[folds_indices] = fold_number
+            folds_column = ids_folds[ids_inverse]
+            groups_folds = (ids, ids_folds)
         else:
             for fold_number, (_, folds_indices) in enumerate(
                     KFold(length, self.n_folds, shuffle=True, random_state=self._random_number)):
                 folds_column[folds_indices] = fold_number
+        self._folds_cache = (key, folds_column, groups_folds)
         return folds_column
 
+    def _get_chunk_folds_column(self, group_column):
+        """
+        Return folds column for a part of data using group ids: groups from training data get their training fold,
+        other groups are assigned to a fold by their position among sorted training ids
+        (so all samples of a group get the same fold in any chunk).
+        """
+        assert self._train_groups is not None, 'Folds of groups are known only after training with group_feature'
+        ids, ids_folds = self._train_groups
+        positions = numpy.searchsorted(ids, group_column)
+        clipped_positions = numpy.minimum(positions, len(ids) - 1)
+        known = ids[clipped_positions] == group_column
+        return numpy.where(known, ids_folds[clipped_positions], positions % self.n_folds)
+
     def fit(self, X, y, sample_weight=None):
         """
         Train the classifier, will train several base classifiers on overlapping
@@ -88,36 +180,129 @@ class FoldingGroupClassifier(Classifier):
         :param y: labels of events - array-like of shape [n_samples]
         :param sample_weight: weight of events,
                array-like of shape [n_samples] or None if all weights are equal
+
+        After training `fit_statistics` contains training time, cpu time and increase of peak memory (Mb)
+        for each fold (if known) and the chosen number of stages, if early stopping is used.
         """
         if hasattr(self.base_estimator, 'features'):
             assert self.base_estimator.features is None, \
                 'Base estimator must have None features! Use features parameter in Folding instead'
         self.train_length = len(X)
         group_column, (X, y, sample_weight) = self._prepare_data(X, y, sample_weight)
+        cache_key = None
+        if self.cache_dir is not None and isinstance(self.random_state, numbers.Integral):
+            try:
+                cache_key = self._get_cache_key(X, y, sample_weight, group_column)
+            except ValueError as error:
+                print('Model is not cached: {}'.format(error))
+            cached = None if cache_key is None else model_cache.load(self.cache_dir, cache_key)
+            if cached is not None:
+                self.__dict__.update(cached)
+                return self
+
         folds_column = self._get_folds_column(len(X), group_column)
+        # (sorted group ids, their folds) to predict out-of-fold by group id
+        self._train_groups = self._folds_cache[2]
 
         for _ in range(self.n_folds):
             self.estimators.append(clone(self.base_estimator))
 
-        if sample_weight is None:
-            weights_iterator = [None] * self.n_folds
+        early_stopping_params = None
+        if self.early_stopping_rounds is not None:
+            assert self.early_stopping_metric in early_stopping.METRICS, \
+                'unknown metric {}'.format(self.early_stopping_metric)
+            early_stopping_params = {'positive_class': self.classes_[-1], 'rounds': self.early_stopping_rounds,
+                                     'step': self.early_stopping_step, 'metric': self.early_stopping_metric}
+
+        n_processes = local_pool.get_n_processes(self.parallel_profile)
+        if n_processes is not None:
+            result = local_pool.train_folds(self.estimators, X, y, sample_weight, folds_column, n_processes,
+                                            early_stopping_params=early_stopping_params)
         else:
-            weights_iterator = (sample_weight[folds_column != index] for index in range(self.n_folds))
-
-        result = map_on_cluster(self.parallel_profile, train_estimator,
-                                range(len(self.estimators)),
-                                self.estimators,
-                                (X.iloc[folds_column != index, :].copy() for index in range(self.n_folds)),
-                                (y[folds_column != index] for index in range(self.n_folds)),
-                                weights_iterator)
-        for status, data in result:
+            if sample_weight is None:
+                weights_iterator = [None] * self.n_folds
+            else:
+                weights_iterator = (sample_weight[folds_column != index] for index in range(self.n_folds))
+            arguments = [range(len(self.estimators)),
+                         self.estimators,
+                         (X.iloc[folds_column != index, :].copy() for index in range(self.n_folds)),
+                         (y[folds_column != index] for index in range(self.n_folds)),
+                         weights_iterator]
+            if early_stopping_params is None:
+                result = map_on_cluster(self.parallel_profile, train_estimator, *arguments)
+            else:
+                # held-out part of each fold and early stopping parameters
+                arguments += [(X.iloc[folds_column == index, :].copy() for index in range(self.n_folds)),
+                              (y[folds_column == index] for index in range(self.n_folds)),
+                              (None if sample_weight is None else sample_weight[folds_column == index]
+                               for index in range(self.n_folds))]
+                arguments += [[early_stopping_params[name]] * self.n_folds
+                              for name in ['positive_class', 'rounds', 'step', 'metric']]
+                result = map_on_cluster(self.parallel_profile, early_stopping.train_estimator_with_early_stopping,
+                                        *arguments)
+            result = ((status, data, numpy.nan, numpy.nan) for status, data in result)
+
+        fit_statistics = []
+        for status, data, peak_rss_increase, cpu_time in result:
             if status == 'success':
-                name, classifier, spent_time = data
+                name, classifier, spent_time = data[:3]
                 self.estimators[name] = classifier
+                fit_statistics.append((name, spent_time, cpu_time, peak_rss_increase) + tuple(data[3:]))
+                instrumentation.record('fit fold', spent_time, cpu_time=cpu_time,
+                                       peak_rss_increase=peak_rss_increase,
+                                       rows=int(numpy.sum(folds_column != name)), fold=name)
             else:
                 print('Problem while training on the node, report:\n', data)
+        columns = ['fold', 'time', 'cpu_time', 'peak_rss_increase']
+        if early_stopping_params is not None:
+            columns.append('best_stage')
+        self.fit_statistics = pandas.DataFrame(fit_statistics, columns=columns)
+        if cache_key is not None and len(fit_statistics) == self.n_folds:
+            cached = {name: getattr(self, name) for name in ['estimators', '_random_number', 'train_features', 'features',
+                                                             '_folds_cache', '_train_groups', 'fit_statistics']}
+            model_cache.save(self.cache_dir, cache_key, cached, max_size=self.cache_size)
         return self
 
+    def _get_cache_key(self, X, y, sample_weight, group_column):
+        """
+        Key of trained folds in cache: parameters of base estimator and folding, features and training data
+        """
+        data_digests = [model_cache.array_digest(X[column].values) for column in X.columns]
+        data_digests += [None if values is None else model_cache.array_digest(values)
+                         for values in [y, sample_weight, group_column]]
+        early_stopping_params = None
+        if self.early_stopping_rounds is not None:
+            early_stopping_params = (self.early_stopping_rounds, self.early_stopping_step, self.early_stopping_metric)
+        return model_cache.get_key(model_cache.describe_params(self.base_estimator), list(X.columns),
+                                   self.group_feature, self.n_folds, self.random_state, data_digests,
+                                   early_stopping_params)
+
+    def _get_thread_pool(self):
+        """
+        :return: pool of `n_threads` threads or None, if predictions should not be parallel
+        """
+        n_threads = self.n_folds if self.n_threads is None else self.n_threads
+        return ThreadPool(n_threads) if n_threads > 1 else None
+
+    def _map_folds(self, function, arguments, pool=None):
+        """
+        Apply function to arguments (one per fold) in a pool of `n_threads` threads.
+        :param pool: existing thread pool to use, by default the new one is created
+        """
+        arguments = list(arguments)
+        if len(arguments) <= 1:
+            return [function(argument) for argument in arguments]
+        if pool is not None:
+            return pool.map(function, arguments)
+        pool = self._get_thread_pool()
+        if pool is None:
+            return [function(argument) for argument in arguments]
+        try:
+            return pool.map(function, arguments)
+        finally:
+            pool.close()
+            pool.join()
+
     def _folding_prediction(self, X, prediction_function, vote_function=None):
         """
         Supplementary function to predict (labels, probabilities, values)
@@ -125,58 +310,112 @@ class FoldingGroupClassifier(Classifier):
         :param prediction_function: function(classifier, X) -> prediction
         :param vote_function: if using averaging over predictions of folds, this function shall be passed.
             For instance: lambda x: numpy.mean(x, axis=0), which means averaging result over all folds.
-            Another useful option is lambda x: numpy.median(x, axis=0)
+            Another useful option is lambda x: numpy.median(x, axis=0).
+            'mean' and 'sum' are computed as running sum without keeping predictions of all folds.
         """
         group_column, X = self._get_features(X)
         if vote_function is not None:
             print('KFold prediction with voting function')
-            results = []
-            for estimator in self.estimators:
-                results.append(prediction_function(estimator, X))
-            # results: [n_classifiers, n_samples, n_dimensions], reduction over 0th axis
-            results = numpy.array(results)
-            return vote_function(results)
+            return self._voting_prediction(X, prediction_function, vote_function)
         else:
             if len(X) != self.train_length:
                 print('KFold prediction using random classifier (length of data passed not equal to length of train)')
             else:
                 print('KFold prediction using folds column')
             folds_column = self._get_folds_column(len(X), group_column)
-            parts = []
-            for fold in range(self.n_folds):
-                parts.append(prediction_function(self.estimators[fold], X.iloc[folds_column == fold, :]))
+            return self._prediction_by_folds(X, folds_column, prediction_function)
 
-            result_shape = [len(X)] + list(numpy.shape(parts[0])[1:])
-            results = numpy.zeros(shape=result_shape)
-            folds_indices = [numpy.where(folds_column == fold)[0] for fold in range(self.n_folds)]
-            for fold, part in enumerate(parts):
-                results[folds_indices[fold]] = part
-            return results
+    def _voting_prediction(self, X, prediction_function, vote_function):
+        """
+        Predict X by all folds' estimators and combine predictions with vote_function
+        """
+        if vote_function in STREAMING_VOTES:
+            lock = threading.Lock()
+            total = []
+
+            def add_fold(estimator):
+                part = prediction_function(estimator, X)
+                with lock:
+                    if len(total) == 0:
+                        total.append(numpy.array(part, dtype=float))
+                    else:
+                        total[0] += part
+
+            self._map_folds(add_fold, self.estimators)
+            return total[0] / len(self.estimators) if vote_function == 'mean' else total[0]
+        else:
+            results = self._map_folds(lambda estimator: prediction_function(estimator, X), self.estimators)
+            # results: [n_classifiers, n_samples, n_dimensions], reduction over 0th axis
+            results = numpy.array(results)
+            return vote_function(results)
+
+    def _prediction_by_folds(self, X, folds_column, prediction_function):
+        """
+        Predict samples of each fold by the estimator of this fold, results are written to one preallocated array
+        """
+        if len(X) == 0:
+            # estimators can not predict an empty frame
+            return numpy.zeros([0, len(self.classes_)])
+        lock = threading.Lock()
+        folds_indices = [numpy.where(folds_column == fold)[0] for fold in range(self.n_folds)]
+        results = []
+
+        def predict_fold(fold):
+            part = prediction_function(self.estimators[fold], X.iloc[folds_indices[fold], :])
+            with lock:
+                if len(results) == 0:
+                    results.append(numpy.zeros([len(X)] + list(numpy.shape(part)[1:])))
+            results[0][folds_indices[fold]] = part
+
+        # folds without samples are skipped, the whole chunk of data may belong to one fold
+        self._map_folds(predict_fold, [fold for fold in range(self.n_folds) if len(folds_indices[fold]) > 0])
+        return results[0]
 
     def _staged_folding_prediction(self, X, prediction_function, vote_function=None):
         group_column, X = self._get_features(X)
         if vote_function is not None:
             print('Using voting KFold prediction')
             iterators = [prediction_function(estimator, X) for estimator in self.estimators]
-            for fold_prob in zip(*iterators):
-                result = numpy.array(fold_prob)
-                yield vote_function(result)
+            for fold_prob in self._staged_zip(iterators):
+                if vote_function in STREAMING_VOTES:
+                    result = numpy.array(fold_prob[0], dtype=float)
+                    for part in fold_prob[1:]:
+                        result += part
+                    yield result / len(fold_prob) if vote_function == 'mean' else result
+                else:
+                    yield vote_function(numpy.array(fold_prob))
         else:
             if len(X) != self.train_length:
                 print('KFold prediction using random classifier (length of data passed not equal to length of train)')
             else:
                 print('KFold prediction using folds column')
             folds_column = self._get_folds_column(len(X), group_column)
-            iterators = [prediction_function(self.estimators[fold], X.iloc[folds_column == fold, :])
-                         for fold in range(self.n_folds)]
             folds_indices = [numpy.where(folds_column == fold)[0] for fold in range(self.n_folds)]
-            for stage_results in zip(*iterators):
+            iterators = [prediction_function(self.estimators[fold], X.iloc[folds_indices[fold], :])
+                         for fold in range(self.n_folds)]
+            for stage_results in self._staged_zip(iterators):
                 result_shape = [len(X)] + list(numpy.shape(stage_results[0])[1:])
                 result = numpy.zeros(result_shape)
                 for fold in range(self.n_folds):
                     result[folds_indices[fold]] = stage_results[fold]
                 yield result
 
+    def _staged_zip(self, iterators):
+        """
+        Same as zip(*iterators), but iterators (one per fold) are advanced concurrently
+        """
+        pool = self._get_thread_pool()
+        try:
+            while True:
+                stage_results = self._map_folds(lambda iterator: next(iterator, None), iterators, pool=pool)
+                if any(result is None for result in stage_results):
+                    return
+                yield stage_results
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
     def _get_feature_importances(self):
         """
         Get features importance
@@ -200,8 +439,8 @@ class FoldingGroupClassifier(Classifier):
 
         :param X: pandas.DataFrame of shape [n_samples, n_features]
         :param vote_function: function to combine prediction of folds' estimators.
-            If None then folding scheme is used.
-        :type vote_function: None or function
+            If None then folding scheme is used. 'mean' and 'sum' are computed as running sum over folds.
+        :type vote_function: None, str or function
         :rtype: numpy.array of shape [n_samples]
         """
         return numpy.argmax(self.predict_proba(X, vote_function=vote_function), axis=1)
@@ -213,8 +452,8 @@ class FoldingGroupClassifier(Classifier):
 
         :param X: pandas.DataFrame of shape [n_samples, n_features]
         :param vote_function: function to combine prediction of folds' estimators.
-            If None then folding scheme is used.
-        :type vote_function: None or function
+            If None then folding scheme is used. 'mean' and 'sum' are computed as running sum over folds.
+        :type vote_function: None, str or function
         :rtype: numpy.array of shape [n_samples, n_classes]
         """
         result = self._folding_prediction(X, prediction_function=get_classifier_probabilities,
@@ -229,14 +468,91 @@ class FoldingGroupClassifier(Classifier):
 
         :param X: pandas.DataFrame of shape [n_samples, n_features]
         :param vote_function: function to combine prediction of folds' estimators.
-            If None then folding scheme is used.
-        :type vote_function: None or function
+            If None then folding scheme is used. 'mean' and 'sum' are computed as running sum over folds.
+        :type vote_function: None, str or function
         :rtype: sequence of numpy.arrays of shape [n_samples, n_classes]
         """
         for proba in self._staged_folding_prediction(X, prediction_function=get_classifier_staged_proba,
                                                      vote_function=vote_function):
             yield proba / numpy.sum(proba, axis=1, keepdims=True)
 
+    def predict_proba_chunks(self, chunks, vote_function=None, out=None):
+        """
+        Predict probabilities for data given by chunks, for instance `pandas.read_csv(..., chunksize=...)`,
+        so only one chunk is kept in memory. Chunks may split groups in any way:
+        groups from training data get their out-of-fold prediction,
+        other groups are assigned to a fold by group id (requires group_feature, if vote_function is None).
+
+        :param chunks: iterable of pandas.DataFrame
+        :param vote_function: function to combine prediction of folds' estimators.
+            If None then folding scheme is used. 'mean' and 'sum' are computed as running sum over folds.
+        :param out: None or array of shape [n_samples, n_classes] (for instance, numpy.memmap),
+            where probabilities are written chunk after chunk
+        :rtype: sequence of numpy.arrays of shape [n_chunk_samples, n_classes]
+        """
+        assert vote_function is not None or self.group_feature is not None, \
+            'Folding prediction by chunks needs group_feature to find folds, pass vote_function instead'
+        offset = 0
+        for chunk in chunks:
+            group_column, X = self._get_features(chunk)
+            if vote_function is not None:
+                proba = self._voting_prediction(X, get_classifier_probabilities, vote_function)
+            else:
+                proba = self._prediction_by_folds(X, self._get_chunk_folds_column(group_column),
+                                                  get_classifier_probabilities)
+            proba /= numpy.sum(proba, axis=1, keepdims=True)
+            if out is not None:
+                out[offset:offset + len(proba)] = proba
+            offset += len(proba)
+            yield proba
+
+    def staged_metric(self, X, y, sample_weight=None, metric='auc', step=10):
+        """
+        Compute weighted metric of out-of-fold predictions after every `step` stages and after the last stage.
+        Only the metric trace is kept, so learning curve costs about the memory of one prediction.
+        Metric is recomputed on all samples at each evaluated stage (predictions of all samples change):
+        log-loss is summed fold by fold, AUC is computed with `WeightedRoc` on a shared buffer (one sort per stage),
+        so choose `step` according to the number of samples.
+
+        :param X: pandas.DataFrame of shape [n_samples, n_features], pass training data to get unbiased estimation
+        :param y: labels of events - array-like of shape [n_samples]
+        :param sample_weight: weight of events, array-like of shape [n_samples] or None if all weights are equal
+        :param str metric: 'auc' or 'log_loss'
+        :param int step: stride between evaluated stages
+        :rtype: pandas.Series with metric values, index is stage number (starting from 1)
+        """
+        assert metric in early_stopping.METRICS, 'unknown metric {}'.format(metric)
+        group_column, X = self._get_features(X)
+        positive = numpy.asarray(y) == self.classes_[-1]
+        sample_weight = numpy.ones(len(X)) if sample_weight is None else numpy.asarray(sample_weight, dtype=float)
+        folds_column = self._get_folds_column(len(X), group_column)
+        folds_indices = [numpy.where(folds_column == fold)[0] for fold in range(self.n_folds)]
+        iterators = [get_classifier_staged_proba(self.estimators[fold], X.iloc[folds_indices[fold], :])
+                     for fold in range(self.n_folds)]
+        # probability of positive class for the current stage, needed only for auc
+        buffer = numpy.zeros(len(X)) if metric == 'auc' else None
+
+        def evaluate(stage_results):
+            if metric == 'log_loss':
+                total = 0.
+                for fold, proba in enumerate(stage_results):
+                    indices = folds_indices[fold]
+                    losses = early_stopping.log_losses(proba[:, -1] / numpy.sum(proba, axis=1), positive[indices])
+                    total += numpy.dot(sample_weight[indices], losses)
+                return total / numpy.sum(sample_weight)
+            for fold, proba in enumerate(stage_results):
+                buffer[folds_indices[fold]] = proba[:, -1] / numpy.sum(proba, axis=1)
+            return early_stopping.metric_value(buffer, positive, sample_weight, metric=metric)
+
+        trace = OrderedDict()
+        stage, stage_results = 0, None
+        for stage, stage_results in enumerate(self._staged_zip(iterators), 1):
+            if stage % step == 0:
+                trace[stage] = evaluate(stage_results)
+        if stage > 0 and stage not in trace:
+            trace[stage] = evaluate(stage_results)
+        return pandas.Series(trace, name=metric)
+
     def get_feature_importances(self):
         """
         Get features importance
@@ -0,0 +1,165 @@
+"""
+Timing and memory instrumentation of pipeline stages.
+
+Stages are marked in the code with `stage` (context manager) or `record` (for externally measured stages,
+e.g. folds trained in other processes). Nothing is measured unless a `Recorder` is active::
+
+    with Recorder() as recorder:
+        get_result_with_bootstrap_for_given_part(...)
+    recorder.to_dataframe()
+
+Each record contains stage name, path of enclosing stages, wall time, cpu time (including finished child
+processes), peak resident memory of the process at the end of the stage and its increase during the stage,
+number of rows and any additional information (e.g. fold).
+"""
+import sys
+import time
+import resource
+import threading
+from contextlib import contextmanager
+
+import numpy
+import pandas
+
+# active recorders
+_recorders = []
+# names of currently open stages in each thread
+_local = threading.local()
+
+COLUMNS = ['path', 'stage', 'wall_time', 'cpu_time', 'peak_rss', 'peak_rss_increase', 'rows']
+
+
+def _read_proc_status(field):
+    """
+    :return: value of memory field (e.g. 'VmRSS') of /proc/self/status in Mb or None if it is not available
+    """
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) / 1024.
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def reset_peak_rss():
+    """
+    Reset peak resident memory of the current process to the current one (linux only),
+    so that peak memory of a task is not hidden by memory inherited from the parent process.
+
+    :return: True if peak was reset
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except (IOError, OSError):
+        return False
+    return _read_proc_status('VmHWM') is not None
+
+
+def get_current_rss():
+    """
+    :return: resident memory of the current process in Mb, peak memory if current is not available
+    """
+    current = _read_proc_status('VmRSS')
+    return get_peak_rss() if current is None else current
+
+
+def get_peak_rss():
+    """
+    :return: peak resident memory of the current process in Mb (since the last `reset_peak_rss`)
+    """
+    peak = _read_proc_status('VmHWM')
+    if peak is not None:
+        return peak
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on linux and in bytes on mac
+    return peak / 1024. ** 2 if sys.platform == 'darwin' else peak / 1024.
+
+
+def get_cpu_time(children=True):
+    """
+    :param bool children: include finished child processes
+    :return: user and system time of the process (and its finished children) in seconds
+    """
+    who = [resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN] if children else [resource.RUSAGE_SELF]
+    usage = [resource.getrusage(item) for item in who]
+    return sum(item.ru_utime + item.ru_stime for item in usage)
+
+
+def _open_stages():
+    if not hasattr(_local, 'stages'):
+        _local.stages = []
+    return _local.stages
+
+
+class Recorder(object):
+    """
+    Collects records of stages executed while recorder is active (inside `with` block).
+    """
+    def __init__(self):
+        self.records = []
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        _recorders.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _recorders.remove(self)
+
+    def add(self, record):
+        with self._lock:
+            self.records.append(record)
+
+    def to_dataframe(self):
+        """
+        :return: pandas.DataFrame with one row per record (in order of stages completion)
+        """
+        extra_columns = sorted(set(key for record in self.records for key in record) - set(COLUMNS))
+        return pandas.DataFrame(self.records, columns=COLUMNS + extra_columns)
+
+
+def is_recording():
+    return len(_recorders) > 0
+
+
+def record(name, wall_time, cpu_time=numpy.nan, peak_rss=numpy.nan, peak_rss_increase=numpy.nan, rows=None, **info):
+    """
+    Add record of a stage measured outside (e.g. in another process) to active recorders.
+
+    :param info: additional columns, e.g. fold=1
+    """
+    if not is_recording():
+        return
+    stages = _open_stages()
+    result = {'path': '/'.join(stages + [name]), 'stage': name, 'wall_time': wall_time, 'cpu_time': cpu_time,
+              'peak_rss': peak_rss, 'peak_rss_increase': peak_rss_increase, 'rows': rows}
+    result.update(info)
+    for recorder in list(_recorders):
+        recorder.add(result)
+
+
+@contextmanager
+def stage(name, rows=None, **info):
+    """
+    Measure the enclosed block as a stage, does nothing if no recorder is active.
+
+    :param name: name of stage
+    :param rows: number of processed rows (samples, events)
+    :param info: additional columns
+    """
+    if not is_recording():
+        yield
+        return
+    stages = _open_stages()
+    stages.append(name)
+    start_wall, start_cpu, start_peak = time.time(), get_cpu_time(), get_peak_rss()
+    try:
+        yield
+    finally:
+        stages.pop()
+        peak_rss = get_peak_rss()
+        record(name, time.time() - start_wall, cpu_time=get_cpu_time() - start_cpu, peak_rss=peak_rss,
+               peak_rss_increase=peak_rss - start_peak, rows=rows, **info)
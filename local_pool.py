@@ -0,0 +1,134 @@
+"""
+Local process-pool backend for training folds.
+
+Feature matrix, labels, weights and folds column are copied once into shared memory,
+each worker process selects its fold from the shared arrays by mask, so training data is not pickled per fold.
+Columns of the feature matrix are shared as one block per dtype, so compact (e.g. float32) columns stay compact.
+Use it in FoldingGroupClassifier with `parallel_profile='processes-N'`.
+"""
+import multiprocessing
+from collections import OrderedDict
+
+import numpy
+import pandas
+from rep.metaml.factory import train_estimator
+
+from early_stopping import train_estimator_with_early_stopping
+from instrumentation import get_cpu_time, get_current_rss, get_peak_rss, reset_peak_rss
+
+PROFILE_PREFIX = 'processes-'
+
+# arrays shared with the worker process, filled by _init_worker
+_shared = {}
+
+
+def get_n_processes(parallel_profile):
+    """
+    :return: number of processes for profile 'processes-N' or None if profile is not local
+    """
+    if parallel_profile is None or not str(parallel_profile).startswith(PROFILE_PREFIX):
+        return None
+    return int(parallel_profile[len(PROFILE_PREFIX):])
+
+
+def share_array(array):
+    """
+    Copy array into shared memory.
+
+    :return: (raw shared buffer, dtype, shape), buffer can be passed to pool initializer
+    """
+    array = numpy.ascontiguousarray(array)
+    buffer = multiprocessing.RawArray('b', max(array.nbytes, 1))
+    numpy.frombuffer(buffer, dtype=array.dtype, count=array.size).reshape(array.shape)[...] = array
+    return buffer, array.dtype.str, array.shape
+
+
+def share_frame(X):
+    """
+    Copy columns of data frame into shared memory, one block of shape [n_columns, n_samples] per dtype.
+
+    :param X: pandas.DataFrame with numeric columns
+    :return: list of ((raw shared buffer, dtype, shape), positions of block columns in X)
+    """
+    positions = OrderedDict()
+    for position, dtype in enumerate(X.dtypes):
+        if dtype.kind not in 'biuf':
+            raise ValueError('column {} of dtype {} can not be shared'.format(X.columns[position], dtype))
+        positions.setdefault(numpy.dtype(dtype), []).append(position)
+    blocks = []
+    for dtype, block_positions in positions.items():
+        shape = (len(block_positions), len(X))
+        buffer = multiprocessing.RawArray('b', max(dtype.itemsize * shape[0] * shape[1], 1))
+        block = _from_shared(buffer, dtype.str, shape)
+        for row, position in enumerate(block_positions):
+            block[row] = X.iloc[:, position].values
+        blocks.append(((buffer, dtype.str, shape), block_positions))
+    return blocks
+
+
+def _from_shared(buffer, dtype, shape):
+    return numpy.frombuffer(buffer, dtype=dtype, count=int(numpy.prod(shape))).reshape(shape)
+
+
+def _init_worker(arrays, blocks, columns):
+    _shared.clear()
+    for name, description in arrays.items():
+        _shared[name] = _from_shared(*description)
+    _shared['X'] = [(_from_shared(*description), positions) for description, positions in blocks]
+    _shared['columns'] = columns
+
+
+def _select(mask):
+    columns = [None] * len(_shared['columns'])
+    for block, positions in _shared['X']:
+        selected = block[:, mask]
+        for row, position in enumerate(positions):
+            columns[position] = selected[row]
+    X = pandas.DataFrame(OrderedDict(enumerate(columns)), columns=range(len(columns)))
+    X.columns = _shared['columns']
+    sample_weight = _shared['sample_weight'][mask] if 'sample_weight' in _shared else None
+    return X, _shared['y'][mask], sample_weight
+
+
+def _train_fold(args):
+    fold, estimator, early_stopping_params = args
+    # forked worker inherits peak memory of the parent, measure only the increase during the task
+    reset_peak_rss()
+    start_rss, start_cpu = get_current_rss(), get_cpu_time(children=False)
+    train_mask = _shared['folds'] != fold
+    if early_stopping_params is None:
+        status, data = train_estimator(fold, estimator, *_select(train_mask))
+    else:
+        arguments = _select(train_mask) + _select(~train_mask)
+        status, data = train_estimator_with_early_stopping(fold, estimator, *arguments, **early_stopping_params)
+    return status, data, max(get_peak_rss() - start_rss, 0.), get_cpu_time(children=False) - start_cpu
+
+
+def train_folds(estimators, X, y, sample_weight, folds_column, n_processes, early_stopping_params=None):
+    """
+    Train estimator number `fold` on all samples with `folds_column != fold` in a local process pool.
+
+    :param estimators: list of not fitted estimators, one for each fold
+    :param X: pandas.DataFrame of shape [n_samples, n_features]
+    :param y: labels, numpy.array of shape [n_samples]
+    :param sample_weight: weights, numpy.array of shape [n_samples] or None
+    :param folds_column: fold index for each sample, numpy.array of shape [n_samples]
+    :param int n_processes: number of worker processes
+    :param early_stopping_params: None or dict of keyword arguments of
+        `early_stopping.train_estimator_with_early_stopping`, the held-out part is `folds_column == fold`
+    :return: list of (status, data, peak_rss_increase, cpu_time) for each fold, where status and data are the same
+        as in `rep.metaml.factory.train_estimator`, peak_rss_increase is increase of the worker peak memory
+        during training (Mb) and cpu_time is user and system time of the worker spent on the fold (seconds)
+    """
+    arrays = {'y': share_array(y), 'folds': share_array(folds_column)}
+    if sample_weight is not None:
+        arrays['sample_weight'] = share_array(sample_weight)
+    # one task per process, so that peak memory is reported for each fold separately
+    pool = multiprocessing.Pool(processes=n_processes, initializer=_init_worker,
+                                initargs=(arrays, share_frame(X), list(X.columns)), maxtasksperchild=1)
+    try:
+        tasks = [(fold, estimator, early_stopping_params) for fold, estimator in enumerate(estimators)]
+        return pool.map(_train_fold, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
@@ -0,0 +1,124 @@
+"""
+Content-addressed cache of trained models in a local directory.
+
+Each entry is a pickle file named by the hash of everything that determines the model
+(estimator parameters, features, training data). Least recently used entries are removed
+when total size of the cache exceeds the limit.
+"""
+import os
+import re
+import types
+import hashlib
+import tempfile
+
+import numpy
+from six.moves import cPickle as pickle
+
+EXTENSION = '.pkl'
+# number of items of object arrays hashed at once
+DIGEST_CHUNK = 10 ** 5
+# default repr of objects contains memory address, which changes from run to run
+_ADDRESS_REPR = re.compile(r' at 0x[0-9a-fA-F]+')
+
+
+def describe_value(value):
+    """
+    Stable description of a parameter value: functions and classes are described by qualified name.
+
+    :raises ValueError: if repr of value contains memory address (such value can not be a part of cache key)
+    """
+    # functions (not bound methods) and classes
+    if isinstance(value, type) or (callable(value) and hasattr(value, '__name__') and hasattr(value, '__module__') and
+                                   isinstance(getattr(value, '__self__', None), (type(None), types.ModuleType))):
+        name = getattr(value, '__qualname__', value.__name__)
+        # lambdas and nested functions are not identified by name
+        if '<' not in name:
+            return getattr(value, '__module__', None), name
+    description = repr(value)
+    if _ADDRESS_REPR.search(description) is not None:
+        raise ValueError('repr of {} depends on memory address, it can not be a part of cache key'.format(description))
+    return description
+
+
+def describe_params(estimator):
+    """
+    Stable description of estimator: class name and (recursively) its parameters.
+    """
+    params = estimator.get_params(deep=False) if hasattr(estimator, 'get_params') else {}
+    description = []
+    for name in sorted(params):
+        value = params[name]
+        description.append((name, describe_params(value) if hasattr(value, 'get_params') else describe_value(value)))
+    return type(estimator).__module__ + '.' + type(estimator).__name__, description
+
+
+def array_digest(array):
+    """
+    :return: hex digest of array content (dtype, shape and values)
+    """
+    array = numpy.asarray(array)
+    sha = hashlib.sha1(repr((array.dtype.str, array.shape)).encode('utf-8'))
+    if array.dtype == object:
+        # by chunks, so that no huge string is built for millions of ids
+        items = array.ravel()
+        for start in range(0, len(items), DIGEST_CHUNK):
+            sha.update(repr(items[start:start + DIGEST_CHUNK].tolist()).encode('utf-8'))
+    else:
+        sha.update(numpy.ascontiguousarray(array).view(numpy.uint8))
+    return sha.hexdigest()
+
+
+def get_key(*parts):
+    """
+    :param parts: strings (descriptions, digests) defining the cached object
+    :return: cache key
+    """
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+
+def load(cache_dir, key):
+    """
+    :return: cached object or None if there is no such entry
+    """
+    path = os.path.join(cache_dir, key + EXTENSION)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as cache_file:
+        value = pickle.load(cache_file)
+    # mark as recently used
+    os.utime(path, None)
+    return value
+
+
+def save(cache_dir, key, value, max_size=None):
+    """
+    Save object to cache and remove least recently used entries if cache is larger than `max_size` bytes.
+    """
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    # write to a temporary file first, so that an interrupted write never leaves a broken entry
+    handle, temp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    with os.fdopen(handle, 'wb') as cache_file:
+        pickle.dump(value, cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.rename(temp_path, os.path.join(cache_dir, key + EXTENSION))
+    if max_size is not None:
+        evict(cache_dir, max_size)
+
+
+def evict(cache_dir, max_size):
+    """
+    Remove least recently used entries until total size is not larger than `max_size` bytes,
+    the most recent entry is always kept.
+    """
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith(EXTENSION):
+            stat = os.stat(os.path.join(cache_dir, name))
+            entries.append((stat.st_mtime, stat.st_size, name))
+    entries.sort()
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, name in entries[:-1]:
+        if total_size <= max_size:
+            break
+        os.remove(os.path.join(cache_dir, name))
+        total_size -= size
@@ -0,0 +1,137 @@
+"""
+Generator of synthetic LHCb-like tagging data with the same columns as `datasets/Tracks.csv`,
+to develop and benchmark the pipeline without the real datasets.
+
+Each event has a B sign, an sWeight (mostly around 1 for signal and around 0 for background)
+and Poisson-distributed number of tracks. The track sign is correlated with the B sign and
+the strength of the correlation depends on PID-like and kinematic features, so taggers can learn it.
+"""
+import numpy
+import pandas
+from sklearn.utils import check_random_state
+
+import data_cache
+
+TRACK_FEATURES = ['partPt', 'partP', 'eta', 'diff_eta', 'diff_phi', 'IPs', 'IP', 'IPerr', 'IPPU', 'ghostProb',
+                  'PIDNNk', 'PIDNNm', 'PIDNNe', 'PIDNNp', 'PIDNNpi', 'EOverP', 'veloch', 'partlcs', 'proj',
+                  'nnkrec', 'ptB', 'mult']
+
+
+def _events(n_events, random_state, mean_tracks, signal_fraction):
+    signB = random_state.choice([-1, 1], size=n_events)
+    is_signal = random_state.rand(n_events) < signal_fraction
+    N_sig_sw = numpy.where(is_signal, random_state.normal(1.05, 0.1, size=n_events),
+                           random_state.normal(-0.1, 0.2, size=n_events))
+    n_tracks = 1 + random_state.poisson(mean_tracks - 1, size=n_events)
+    return signB, N_sig_sw, is_signal, n_tracks
+
+
+def generate_tracks(n_events, mean_tracks=8., signal_fraction=0.8, run=1, first_event=0, random_state=None,
+                    return_true_probs=False):
+    """
+    Generate tracks of synthetic events.
+
+    :param int n_events: number of events
+    :param float mean_tracks: mean number of tracks in event (at least one track in each event)
+    :param float signal_fraction: fraction of signal events (background events are not tagged)
+    :param run: run number of generated events
+    :param first_event: number of the first event, to generate data by parts
+    :param random_state: random state or seed
+    :param return_true_probs: return also true probability that the track has the same sign as B
+    :return: pandas.DataFrame with columns of `Tracks.csv`, packed int64 `event_id` and `label`
+        (1 if track and B signs are the same) [, true probabilities]
+    """
+    random_state = check_random_state(random_state)
+    signB, N_sig_sw, is_signal, n_tracks = _events(n_events, random_state, mean_tracks, signal_fraction)
+    event = numpy.repeat(numpy.arange(first_event, first_event + n_events), n_tracks)
+    track_event = numpy.repeat(numpy.arange(n_events), n_tracks)
+    n = len(event)
+
+    data = pandas.DataFrame({'run': numpy.zeros(n, dtype=numpy.int64) + run, 'event': event})
+    data['i'] = numpy.arange(n) - numpy.repeat(numpy.cumsum(n_tracks) - n_tracks, n_tracks)
+    data['mult'] = n_tracks[track_event]
+    data['nnkrec'] = (1 + random_state.poisson(1.5, size=n_events))[track_event]
+    data['ptB'] = random_state.gamma(3., 2., size=n_events)[track_event]
+    data['Bmass'] = random_state.normal(5279., 20., size=n_events)[track_event]
+    data['partPt'] = 0.2 + random_state.exponential(1.2, size=n)
+    data['eta'] = random_state.uniform(2., 5., size=n)
+    data['partP'] = data['partPt'].values * numpy.cosh(data['eta'].values)
+    data['diff_eta'] = random_state.normal(0., 1., size=n)
+    data['diff_phi'] = random_state.uniform(-numpy.pi, numpy.pi, size=n)
+    data['IPerr'] = random_state.gamma(2., 0.01, size=n)
+    data['IPs'] = numpy.abs(random_state.standard_t(3, size=n)) * 3
+    data['IP'] = data['IPs'].values * data['IPerr'].values
+    data['IPPU'] = random_state.exponential(20., size=n)
+    data['ghostProb'] = random_state.beta(1., 12., size=n)
+    # particle type defines which PID response is high
+    kind = random_state.choice(5, size=n, p=[0.15, 0.05, 0.05, 0.1, 0.65])
+    for i, column in enumerate(['PIDNNk', 'PIDNNm', 'PIDNNe', 'PIDNNp', 'PIDNNpi']):
+        data[column] = numpy.where(kind == i, random_state.beta(5., 1.5, size=n), random_state.beta(1., 8., size=n))
+    data['EOverP'] = numpy.where(kind == 2, random_state.normal(1., 0.1, size=n), random_state.gamma(1.5, 0.15, size=n))
+    data['veloch'] = random_state.normal(1., 0.15, size=n)
+    data['partlcs'] = random_state.gamma(2., 0.7, size=n)
+    data['proj'] = data['partP'].values * data['ptB'].values * random_state.uniform(0., 1., size=n)
+
+    # tagging power: leptons and kaons with high pt carry the B flavour
+    score = 2. * data['PIDNNk'].values + 1.5 * data['PIDNNm'].values + 1.5 * data['PIDNNe'].values + \
+        0.3 * numpy.log(data['partPt'].values) - 0.2 * numpy.abs(data['diff_eta'].values) - 1.5
+    probs = 0.5 + 0.25 * numpy.tanh(score)
+    probs = numpy.where(is_signal[track_event], probs, 0.5)
+    same_sign = random_state.rand(n) < probs
+    data['signB'] = signB[track_event]
+    data['signTrack'] = numpy.where(same_sign, 1, -1) * data['signB'].values
+    data['N_sig_sw'] = N_sig_sw[track_event]
+    data['label'] = same_sign * 1
+    data['event_id'] = data_cache.pack_event_id(data['run'].values, data['event'].values)
+    if return_true_probs:
+        return data, probs
+    return data
+
+
+def generate_vertices(tracks, vertex_fraction=0.3, random_state=None):
+    """
+    Generate secondary vertices for a part of events of generated tracks (at most one vertex per event),
+    with the same columns as used from `1016_vtx.root`.
+
+    :param tracks: pandas.DataFrame from `generate_tracks`
+    :param float vertex_fraction: fraction of events with vertex
+    :return: pandas.DataFrame
+    """
+    random_state = check_random_state(random_state)
+    first = tracks['i'].values == 0
+    events = tracks[first]
+    events = events[random_state.rand(len(events)) < vertex_fraction]
+    n = len(events)
+    data = pandas.DataFrame({'event_id': events['event_id'].values, 'runNum': events['run'].values,
+                             'evtNum': events['event'].values, 'mult': events['mult'].values,
+                             'nnkrec': events['nnkrec'].values, 'ptB': events['ptB'].values,
+                             'signB': events['signB'].values, 'N_sig_sw': events['N_sig_sw'].values})
+    data['vflag'] = 2 + random_state.poisson(1., size=n)
+    data['ipsmean'] = random_state.gamma(3., 2., size=n)
+    data['ptmean'] = random_state.gamma(3., 0.5, size=n)
+    data['svm'] = random_state.gamma(4., 0.6, size=n)
+    data['svp'] = random_state.gamma(3., 15., size=n)
+    data['BDphiDir'] = random_state.uniform(0., numpy.pi, size=n)
+    data['svtau'] = random_state.exponential(1., size=n)
+    data['docamax'] = random_state.exponential(0.05, size=n)
+    probs = 0.5 + 0.2 * numpy.tanh(0.3 * data['svm'].values - 0.5)
+    probs[data['N_sig_sw'].values < 0.5] = 0.5
+    data['vcharge'] = random_state.normal(0., 0.5, size=n) + 0.5 * data['signB'].values * (2 * probs - 1)
+    data['signVtx'] = numpy.where(random_state.rand(n) < probs, 1, -1) * data['signB'].values
+    data['label'] = (data['signVtx'].values * data['signB'].values > 0) * 1
+    return data
+
+
+def write_tracks_csv(path, n_events, chunk_events=10 ** 6, random_state=None, **kwargs):
+    """
+    Write generated tracks to tab-separated csv (as `Tracks.csv`) by parts, so that large files
+    can be generated with limited memory.
+
+    :param kwargs: parameters of `generate_tracks`
+    """
+    random_state = check_random_state(random_state)
+    for start in range(0, n_events, chunk_events):
+        part = generate_tracks(min(chunk_events, n_events - start), first_event=start, random_state=random_state,
+                               **kwargs)
+        part = part.drop(['event_id', 'label'], axis=1)
+        part.to_csv(path, sep='\t', index=False, mode='w' if start == 0 else 'a', header=start == 0)
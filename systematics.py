@@ -0,0 +1,255 @@
+"""
+Runner of systematic studies: the same tagging procedure for a grid of configurations (seeds, calibrations, models).
+
+Independent runs are executed in a local process pool. Each finished run is saved to the output directory
+(result row and B-level arrays), so an interrupted study resumes from the first unfinished run.
+Stages shared by several runs (e.g. the same track model for different vertex calibrations) are computed once
+with `StageMemo`, which keeps their results on disk.
+
+Example::
+
+    def tagging(config, memo):
+        Bdata_tracks = memo.get('tracks', [config['track_estimator'], config['track_logistic'], config['random_state']],
+                                prepare_tracks, config)
+        ...
+        return result_table(...), {'Bprob': Bprob, 'Bsign': Bsign, 'Bweight': Bweight}
+
+    configs = make_grid(random_state=random_states, track_logistic=[True, False])
+    results = run_study(tagging, configs, 'systematics/full', n_processes=4)
+"""
+import os
+import time
+import errno
+import socket
+import itertools
+import multiprocessing
+from collections import OrderedDict
+
+import numpy
+import pandas
+
+import model_cache
+
+RUNS_SUBDIR = 'runs'
+STAGES_SUBDIR = 'stages'
+LOCK_EXTENSION = '.lock'
+# saved instead of None results of stages (model_cache.load returns None for missing entries)
+NONE_RESULT = '__stage_returned_none__'
+
+
+def make_grid(**options):
+    """
+    Cartesian product of options.
+
+    :param options: name=list of values
+    :return: list of OrderedDicts {name: value}, one per configuration
+    """
+    names = sorted(options)
+    return [OrderedDict(zip(names, values)) for values in itertools.product(*[options[name] for name in names])]
+
+
+def describe(value):
+    """
+    Stable description of a configuration value (estimators are described by their parameters)
+    """
+    if hasattr(value, 'get_params'):
+        return model_cache.describe_params(value)
+    if isinstance(value, numpy.ndarray):
+        return model_cache.array_digest(value)
+    if isinstance(value, (list, tuple)):
+        return [describe(item) for item in value]
+    if isinstance(value, dict):
+        return [(key, describe(value[key])) for key in sorted(value)]
+    return model_cache.describe_value(value)
+
+
+def get_run_key(config):
+    """
+    :return: key of run, which identifies its saved results
+    """
+    return model_cache.get_key(describe(config))
+
+
+def _lock_owner():
+    return '{} {}'.format(socket.gethostname(), os.getpid())
+
+
+def _is_dead_owner(owner):
+    """
+    :param owner: content of lock file, see `_lock_owner`
+    :return: True if lock was taken by a process of this host, which does not exist anymore
+    """
+    parts = owner.split()
+    if len(parts) != 2 or parts[0] != socket.gethostname() or not parts[1].isdigit():
+        return False
+    try:
+        os.kill(int(parts[1]), 0)
+    except OSError as error:
+        return error.errno == errno.ESRCH
+    return False
+
+
+def _read_lock(lock_path):
+    try:
+        with open(lock_path) as lock_file:
+            return lock_file.read()
+    except (IOError, OSError):
+        return ''
+
+
+def _break_dead_lock(lock_path):
+    """
+    Remove lock if its owner process is dead (e.g. killed pool worker).
+    At worst, a stage is computed twice, results are the same.
+
+    :return: True if lock was removed
+    """
+    owner = _read_lock(lock_path)
+    if not _is_dead_owner(owner):
+        return False
+    try:
+        os.remove(lock_path)
+    except OSError:
+        pass
+    return True
+
+
+class StageMemo(object):
+    """
+    On-disk memo of intermediate results shared by runs (also by runs in other processes).
+    A stage, which is being computed by another process, is waited for instead of being recomputed.
+    Lock of a stage contains host and pid of its owner, locks of dead processes of this host are broken.
+
+    :param str directory: directory for stage results
+    :param float poll_interval: interval (seconds) to check a stage computed by another process
+    """
+    def __init__(self, directory, poll_interval=5.):
+        self.directory = directory
+        self.poll_interval = poll_interval
+
+    def clear_locks(self):
+        """
+        Remove locks left by interrupted processes (locks of running processes, e.g. of a concurrent study, are kept)
+        """
+        if not os.path.exists(self.directory):
+            return
+        for name in os.listdir(self.directory):
+            if name.endswith(LOCK_EXTENSION):
+                _break_dead_lock(os.path.join(self.directory, name))
+
+    def get(self, name, key_parts, function, *args, **kwargs):
+        """
+        Return result of stage, computing `function(*args, **kwargs)` only if it was not computed yet.
+
+        :param str name: name of stage
+        :param key_parts: everything which determines result of the stage (estimators, flags, seeds)
+        """
+        key = model_cache.get_key(name, describe(key_parts))
+        lock_path = os.path.join(self.directory, key + LOCK_EXTENSION)
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        while True:
+            value = model_cache.load(self.directory, key)
+            if isinstance(value, str) and value == NONE_RESULT:
+                return None
+            if value is not None:
+                return value
+            try:
+                lock = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except OSError:
+                # another process computes this stage, unless it died
+                if not _break_dead_lock(lock_path):
+                    time.sleep(self.poll_interval)
+                continue
+            try:
+                os.write(lock, _lock_owner().encode('utf-8'))
+            finally:
+                os.close(lock)
+            try:
+                value = function(*args, **kwargs)
+                model_cache.save(self.directory, key, NONE_RESULT if value is None else value)
+                return value
+            finally:
+                os.remove(lock_path)
+
+
+def _run(args):
+    run_function, config, output_dir = args
+    memo = StageMemo(os.path.join(output_dir, STAGES_SUBDIR))
+    start = time.time()
+    result, arrays = run_function(config, memo)
+    if isinstance(result, pandas.DataFrame):
+        result = OrderedDict((column, result[column].values[0]) for column in result.columns)
+    key = get_run_key(config)
+    runs_dir = os.path.join(output_dir, RUNS_SUBDIR)
+    numpy.savez(os.path.join(runs_dir, key + '.npz'), **(arrays or {}))
+    # record is saved last, so the run is treated as finished only if everything is saved
+    model_cache.save(runs_dir, key, {'config': config, 'result': result, 'time': time.time() - start})
+    return key
+
+
+def load_run(output_dir, config):
+    """
+    :return: (record, arrays) of a finished run, where record is dict with keys 'config', 'result', 'time',
+        or None if the run is not finished
+    """
+    runs_dir = os.path.join(output_dir, RUNS_SUBDIR)
+    key = get_run_key(config)
+    record = model_cache.load(runs_dir, key)
+    if record is None:
+        return None
+    with numpy.load(os.path.join(runs_dir, key + '.npz')) as stored:
+        arrays = {name: stored[name] for name in stored.files}
+    return record, arrays
+
+
+def collect_results(output_dir, configs):
+    """
+    :return: pandas.DataFrame with configuration and result of each finished run
+    """
+    rows = []
+    for config in configs:
+        record = model_cache.load(os.path.join(output_dir, RUNS_SUBDIR), get_run_key(config))
+        if record is None:
+            continue
+        row = OrderedDict((name, value if numpy.isscalar(value) else str(value)) for name, value in config.items())
+        row.update(record['result'])
+        row['time'] = record['time']
+        rows.append(row)
+    return pandas.DataFrame(rows)
+
+
+def run_study(run_function, configs, output_dir, n_processes=1):
+    """
+    Run `run_function` for each configuration, skipping runs finished before.
+
+    :param run_function: function(config, memo) -> (result, arrays), where result is a dict of values
+        or a one-row pandas.DataFrame (e.g. `utils.result_table`) and arrays is a dict of numpy.arrays (B data);
+        it should be defined at module level to be passed to other processes
+    :param configs: list of dicts, e.g. from `make_grid`
+    :param str output_dir: directory for results of runs and shared stages
+    :param int n_processes: number of runs executed in parallel
+    :return: pandas.DataFrame, see `collect_results`
+    """
+    runs_dir = os.path.join(output_dir, RUNS_SUBDIR)
+    if not os.path.exists(runs_dir):
+        os.makedirs(runs_dir)
+    StageMemo(os.path.join(output_dir, STAGES_SUBDIR)).clear_locks()
+    finished = set(name[:-len(model_cache.EXTENSION)] for name in os.listdir(runs_dir)
+                   if name.endswith(model_cache.EXTENSION))
+    pending = [config for config in configs if get_run_key(config) not in finished]
+    print('{} runs finished, {} runs to do'.format(len(configs) - len(pending), len(pending)))
+    tasks = [(run_function, config, output_dir) for config in pending]
+    if n_processes == 1:
+        for task in tasks:
+            _run(task)
+    elif len(tasks) > 0:
+        # a new process for each run releases memory of trained models
+        pool = multiprocessing.Pool(processes=n_processes, maxtasksperchild=1)
+        try:
+            for _ in pool.imap_unordered(_run, tasks):
+                pass
+        finally:
+            pool.close()
+            pool.join()
+    return collect_results(output_dir, configs)
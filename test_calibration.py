@@ -0,0 +1,64 @@
+"""
+Checks of symmetric calibration against isotonic regression on symmetrized (duplicated) data
+and of calibrator persistence.
+"""
+import os
+import shutil
+import tempfile
+
+import numpy
+from scipy.special import expit
+from sklearn.isotonic import IsotonicRegression
+
+import utils
+
+
+def _discretized_data(n_samples=100000, random_state=0):
+    # probabilities after isotonic calibration of parts take few values expit(l), with pairs expit(l) and expit(-l)
+    random_state = numpy.random.RandomState(random_state)
+    levels = numpy.linspace(-3, 3, 41)
+    probs = expit(0.3 * (random_state.choice(levels, size=n_samples) + random_state.choice(levels, size=n_samples)))
+    labels = numpy.where(random_state.rand(n_samples) < probs, 1, -1)
+    weights = random_state.uniform(0.1, 2, size=n_samples)
+    return labels, weights, probs
+
+
+def _duplicated_isotonic(labels, weights, probs):
+    # p and 1 - (1 - p) are made exactly equal, as they are merged in the symmetric fit
+    x = numpy.round(numpy.r_[probs, 1 - probs], 12)
+    estimator = IsotonicRegression(y_min=0, y_max=1, out_of_bounds='clip')
+    return estimator.fit(x, numpy.r_[labels > 0, labels <= 0], numpy.r_[weights, weights] / 2)
+
+
+def test_symmetric_isotonic_discretized():
+    labels, weights, probs = _discretized_data()
+    symmetric = utils.SymmetricIsotonicRegression().fit(probs, labels > 0, weights)
+    reference = _duplicated_isotonic(labels, weights, probs)
+    assert numpy.allclose(symmetric.transform(probs), reference.transform(numpy.round(probs, 12)), atol=1e-10)
+    calibrator = utils.Calibrator.from_estimator(symmetric, probs)
+    assert numpy.allclose(calibrator.transform(probs), symmetric.transform(probs), atol=1e-12)
+
+
+def test_symmetric_bootstrap_discretized():
+    labels, weights, probs = _discretized_data()
+    D2, _ = utils.bootstrap_calibrate_prob(labels, weights, probs, n_calibrations=3, symmetrize=True, random_state=1)
+    seeds = numpy.random.RandomState(1).randint(0, 2 ** 31 - 1, size=3)
+    for seed, replicate_D2 in zip(seeds, D2):
+        train = utils._bootstrap_train_mask(seed, {'probs': probs})
+        reference = _duplicated_isotonic(labels[train], weights[train], probs[train])
+        calibrated = reference.transform(numpy.round(probs[~train], 12))
+        assert numpy.isclose(replicate_D2, numpy.average((1 - 2 * calibrated) ** 2, weights=weights[~train]), atol=1e-10)
+
+
+def test_calibrator_save_load_without_suffix():
+    calibrator = utils.Calibrator(numpy.linspace(0, 0.5, 11), numpy.linspace(0.1, 0.5, 11), inEtaSpace=True)
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'calibrator')
+        calibrator.save(path)
+        loaded = utils.Calibrator.load(path)
+    finally:
+        shutil.rmtree(directory)
+    probs = numpy.linspace(0, 1, 101)
+    assert loaded.inEtaSpace is True
+    assert numpy.array_equal(loaded.transform(probs), calibrator.transform(probs))
@@ -0,0 +1,59 @@
+"""
+Checks of derived features against the notebook code.
+"""
+import os
+import shutil
+import tempfile
+
+import numpy
+import pandas
+
+import synthetic
+import derived_features
+
+
+def _notebook_features(data_nan):
+    # the same steps as in track-based-tagging.ipynb
+    data = data_nan.dropna()
+    event_id = data.run.apply(str) + '_' + data.event.apply(str)
+    _, event_index = numpy.unique(event_id.values.astype(str), return_inverse=True)
+    max_pt = numpy.zeros(max(event_index) + 1) - numpy.inf
+    numpy.maximum.at(max_pt, event_index, data.partPt.values)
+    result = pandas.DataFrame({'diff_pt': max_pt[event_index] - data.partPt.values,
+                               'cos_diff_phi': numpy.cos(data.diff_phi.values)}, index=data.index)
+    PIDs = {'k': data.PIDNNk.values, 'e': data.PIDNNe.values, 'mu': data.PIDNNm.values}
+    for (pid_name1, pid_values1), (pid_name2, pid_values2) in [(('mu', PIDs['mu']), ('k', PIDs['k'])),
+                                                               (('mu', PIDs['mu']), ('e', PIDs['e'])),
+                                                               (('k', PIDs['k']), ('e', PIDs['e']))]:
+        result['max_PID_{}_{}'.format(pid_name1, pid_name2)] = numpy.maximum(pid_values1, pid_values2)
+        result['sum_PID_{}_{}'.format(pid_name1, pid_name2)] = pid_values1 + pid_values2
+    return result
+
+
+def test_load_features_with_nan_rows():
+    random_state = numpy.random.RandomState(0)
+    data = synthetic.generate_tracks(2000, random_state=random_state).drop(['event_id', 'label'], axis=1)
+    # NaN in other columns, also for tracks with the highest pt in event
+    highest = data.groupby('event')['partPt'].transform('max').values == data['partPt'].values
+    data.loc[highest & (random_state.rand(len(data)) < 0.3), 'IPs'] = numpy.nan
+    data.loc[random_state.rand(len(data)) < 0.05, 'ghostProb'] = numpy.nan
+    directory = tempfile.mkdtemp()
+    try:
+        csv_path = os.path.join(directory, 'Tracks.csv')
+        data.to_csv(csv_path, sep='\t', index=False)
+        features = derived_features.load_features(csv_path)
+        cached = derived_features.load_features(csv_path)
+        unfiltered = derived_features.load_features(csv_path, dropna=False)
+    finally:
+        shutil.rmtree(directory)
+
+    expected = _notebook_features(data)
+    assert list(features.columns) == [name for name in expected.columns if name in features.columns]
+    assert set(features.columns) == set(expected.columns)
+    complete = data.notnull().all(axis=1).values
+    assert numpy.all(numpy.isnan(features['diff_pt'].values[~complete]))
+    for name in expected.columns:
+        assert numpy.allclose(features[name].values[complete], expected[name].values), name
+        assert numpy.allclose(cached[name].values[complete], expected[name].values), name
+    # dropped tracks with the highest pt change diff_pt, filtered and unfiltered caches are different
+    assert not numpy.allclose(unfiltered['diff_pt'].values[complete], expected['diff_pt'].values)
@@ -0,0 +1,116 @@
+"""
+Checks of per-event and metric kernels against the straightforward pandas/numpy/sklearn computations they replace.
+"""
+import numpy
+import pandas
+from scipy.special import expit
+from sklearn.metrics import roc_auc_score, roc_curve
+
+import utils
+
+
+def _tracks(n_samples=5000, n_events=700, random_state=0):
+    random_state = numpy.random.RandomState(random_state)
+    event_ids = random_state.randint(0, n_events, size=n_samples) * 7 + 3
+    event_weights = random_state.uniform(0.1, 1.5, size=n_events * 7 + 3)
+    signB = numpy.where(random_state.rand(n_events * 7 + 3) > 0.5, 1, -1)
+    return pandas.DataFrame({'event_id': event_ids,
+                             'N_sig_sw': event_weights[event_ids],
+                             'signB': signB[event_ids],
+                             'signTrack': numpy.where(random_state.rand(n_samples) > 0.5, 1, -1),
+                             'x': random_state.randn(n_samples),
+                             'y': random_state.randn(n_samples),
+                             'probs': random_state.uniform(0.05, 0.95, size=n_samples)})
+
+
+def test_event_index_reduce():
+    data = _tracks()
+    grouped = data.groupby('event_id')
+    for ids in [data.event_id.values, pandas.Categorical(data.event_id.values)]:
+        index = utils.EventIndex(ids)
+        assert numpy.array_equal(index.event_ids, grouped.size().index.values)
+        assert numpy.array_equal(index.counts, grouped.size().values)
+        sums = index.reduce([data.x.values, data.y.values])
+        assert numpy.allclose(sums, grouped[['x', 'y']].sum().values)
+        maxima = index.reduce([data.x.values, data.y.values], numpy.maximum)
+        assert numpy.array_equal(maxima, grouped[['x', 'y']].max().values)
+    sums32 = utils.EventIndex(data.event_id.values).reduce([data.x.values.astype(numpy.float32)])
+    assert sums32.dtype == numpy.float32
+    assert numpy.allclose(sums32[:, 0], grouped.x.sum().values, atol=1e-4)
+
+
+def _bincount_B_prob(data, probs, normed_signs):
+    # computation of p(B+) before the segmented reduction
+    result_event_id, data_ids = numpy.unique(data['event_id'].values, return_inverse=True)
+    log_probs = numpy.log(probs) - numpy.log(1 - probs)
+    sign_weights = numpy.ones(len(log_probs))
+    if normed_signs:
+        for sign in [-1, 1]:
+            maskB = (data['signB'].values == sign)
+            maskPart = (data['signTrack'].values == 1)
+            sign_weights[maskB * maskPart] *= sum(maskB * (~maskPart)) * 1. / sum(maskB * maskPart)
+    log_probs *= sign_weights * data['signTrack'].values
+    result_logprob = numpy.bincount(data_ids, weights=log_probs)
+    result_label = numpy.bincount(data_ids, weights=data['signB'].values) / numpy.bincount(data_ids)
+    result_weight = numpy.bincount(data_ids, weights=data['N_sig_sw']) / numpy.bincount(data_ids)
+    return result_label, result_weight, expit(result_logprob), result_event_id
+
+
+def test_compute_B_prob_using_part_prob():
+    data = _tracks()
+    for normed_signs in [False, True]:
+        expected = _bincount_B_prob(data, data.probs.values, normed_signs)
+        result = utils.compute_B_prob_using_part_prob(data, data.probs.values, normed_signs=normed_signs)
+        for value, expected_value in zip(result, expected):
+            assert numpy.allclose(value, expected_value, rtol=1e-10, atol=1e-12)
+
+
+def test_weighted_roc():
+    random_state = numpy.random.RandomState(1)
+    n_samples = 3000
+    labels = numpy.where(random_state.rand(n_samples) > 0.4, 1, -1)
+    # discretized probabilities to have ties
+    probs = numpy.round(expit(0.5 * labels + random_state.randn(n_samples)), 2)
+    weights = random_state.uniform(0.1, 2, size=[4, n_samples])
+    roc = utils.WeightedRoc(labels, probs)
+    aucs = roc.auc(weights)
+    for auc, sample_weight in zip(aucs, weights):
+        assert numpy.isclose(auc, roc_auc_score(labels, probs, sample_weight=sample_weight), rtol=1e-12)
+
+    # untagged events with probability 0.5, as in `calculate_auc_with_and_without_untag_events`
+    extra = 300.
+    auc_full = roc.auc(weights[0], extra_positive=extra, extra_negative=extra)
+    expected = roc_auc_score(numpy.r_[labels, -1, 1], numpy.r_[probs, 0.5, 0.5],
+                             sample_weight=numpy.r_[weights[0], extra, extra])
+    assert numpy.isclose(auc_full, expected, rtol=1e-12)
+
+    fpr, tpr, _ = roc.roc_curve(weights[0])
+    expected_fpr, expected_tpr, _ = roc_curve(labels, probs, sample_weight=weights[0], drop_intermediate=False)
+    assert numpy.allclose(fpr, expected_fpr) and numpy.allclose(tpr, expected_tpr)
+
+
+def test_get_top_k_ids():
+    data = _tracks()
+    data.loc[data.index[::17], 'x'] = numpy.nan
+    for labels in [None, data.signTrack.values]:
+        keys = ['event_id'] if labels is None else ['event_id', 'signTrack']
+        selected = data.dropna(subset=['x']).sort_values(keys + ['x'], ascending=[True] * len(keys) + [False])
+        for k in [1, 3]:
+            expected = selected.groupby(keys).head(k).index.values
+            result = utils.get_top_k_ids(data.x.values, data.event_id.values, k=k, labels=labels)
+            assert numpy.array_equal(result, expected)
+
+
+def test_cut_scan():
+    data = _tracks()
+    base_mask = data.probs.values > 0.2
+    thresholds = [numpy.linspace(-1, 2, 7), numpy.linspace(0, 3, 5)]
+    N_B = 1000.
+    efficiency, error = utils.CutScan(data, ['x', 'y'], base_mask=base_mask).efficiency(thresholds, N_B=N_B)
+    event_weights = data.groupby('event_id').N_sig_sw.mean()
+    for i, x_cut in enumerate(thresholds[0]):
+        for j, y_cut in enumerate(thresholds[1]):
+            passed = data[base_mask & ((data.x.values > x_cut) | (data.y.values > y_cut))]
+            N_B_passed = event_weights[numpy.unique(passed.event_id)].sum()
+            assert numpy.isclose(efficiency[i, j], N_B_passed / N_B)
+            assert numpy.isclose(error[i, j], numpy.sqrt(N_B_passed) / N_B)
@@ -1,44 +1,204 @@
+import time
+
 import numpy
 import pandas
 from collections import OrderedDict
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 
-from sklearn import clone
-from sklearn.metrics import roc_auc_score
 from sklearn.linear_model import LogisticRegression
-from sklearn.isotonic import IsotonicRegression
+from sklearn.isotonic import IsotonicRegression, isotonic_regression
+from sklearn.utils import check_random_state
 
 from matplotlib import pyplot as plt
-from rep.utils import train_test_split, train_test_split_group, Flattener
+from rep.utils import train_test_split, Flattener
 from scipy.special import logit, expit
 from matplotlib import pyplot as plt
-from sklearn.metrics import roc_curve
+
+import instrumentation
+from weighted_roc import WeightedRoc
 
 
 def union(*arrays):
     return numpy.concatenate(arrays)
 
 
-def get_events_statistics(data, id_column='event_id'):
+def float_dtype(*arrays):
+    """
+    Float dtype to process arrays without upcasting: float32 if all arrays are float32 (or small integers),
+    float64 otherwise.
+    """
+    return numpy.result_type(numpy.float32, *[numpy.asarray(array).dtype for array in arrays])
+
+
+class EventIndex(object):
+    """
+    Grouping of samples (tracks/vertices) by event, computed once and shared by all per-event reductions.
+
+    :param ids: numpy.array of shape [n_samples] with event id for each sample or pandas.Categorical
+        (only integer codes are grouped then)
+
+    Attributes: `event_ids` - sorted unique ids (in order of categories for pandas.Categorical),
+    `inverse` - event number for each sample, `counts` - number of samples in each event.
     """
+    def __init__(self, ids):
+        self.categories = None
+        if isinstance(ids, pandas.Series):
+            ids = ids.values
+        if isinstance(ids, pandas.Categorical):
+            self.categories = ids.categories
+            self.ids = numpy.asarray(ids.codes)
+            codes, self.inverse, self.counts = numpy.unique(self.ids, return_inverse=True, return_counts=True)
+            self.event_ids = numpy.asarray(self.categories)[codes]
+        else:
+            self.ids = numpy.asarray(ids)
+            self.event_ids, self.inverse, self.counts = numpy.unique(self.ids, return_inverse=True,
+                                                                     return_counts=True)
+        self._order = None
+
+    @property
+    def n_events(self):
+        return len(self.event_ids)
+
+    @property
+    def n_samples(self):
+        return len(self.ids)
+
+    @property
+    def order(self):
+        """
+        Stable permutation of samples, which puts samples of the same event together (events in `event_ids` order)
+        """
+        if self._order is None:
+            self._order = numpy.argsort(self.inverse, kind='mergesort')
+        return self._order
+
+    @property
+    def offsets(self):
+        """
+        :return: position of the first sample of each event in `order`
+        """
+        return numpy.cumsum(self.counts) - self.counts
+
+    def reduce(self, columns, function=numpy.add, dtype=None):
+        """
+        Segmented reduction of several columns in one pass: columns are put into one array sorted by event
+        and reduced over contiguous segments.
+
+        :param columns: list of numpy.arrays of shape [n_samples]
+        :param function: numpy ufunc for reduction, e.g. numpy.add, numpy.maximum, numpy.minimum
+        :param dtype: dtype of computations, numpy.float32 halves memory traffic;
+            None means float32 for float32 columns and float64 otherwise (see `float_dtype`)
+        :return: numpy.array of shape [n_events, n_columns]
+        """
+        if dtype is None:
+            dtype = float_dtype(*columns)
+        values = numpy.empty((self.n_samples, len(columns)), dtype=dtype)
+        for i, column in enumerate(columns):
+            values[:, i] = numpy.asarray(column)[self.order]
+        return function.reduceat(values, self.offsets, axis=0)
+
+    def matches(self, ids):
+        """
+        Check that index was built for these ids (i.e. data was not filtered or reordered since then)
+        """
+        if isinstance(ids, pandas.Series):
+            ids = ids.values
+        if isinstance(ids, pandas.Categorical):
+            if self.categories is None or not ids.categories.equals(self.categories):
+                return False
+            ids = ids.codes
+        elif self.categories is not None:
+            return False
+        ids = numpy.asarray(ids)
+        if ids is self.ids:
+            return True
+        return len(ids) == self.n_samples and numpy.array_equal(ids, self.ids)
+
+
+def get_event_index(data, id_column='event_id', event_index=None):
+    """
+    Return `event_index` if it is still valid for data, otherwise build a new one.
+
+    :param data: pandas.DataFrame
+    :param id_column: column with event id
+    :param event_index: EventIndex or None
+    :return: EventIndex
+    """
+    ids = data[id_column].values
+    if event_index is not None and event_index.matches(ids):
+        return event_index
+    return EventIndex(ids)
+
+
+def get_top_k_ids(values, event_ids=None, k=1, labels=None, event_index=None):
+    """
+    Indices of samples (tracks/vertices) with the highest values in each event,
+    each of k passes is one segmented maximum over samples sorted by event.
+
+    :param values: numpy.array of shape [n_samples], samples with nan values are never selected
+    :param event_ids: numpy.array of shape [n_samples] with event id, not needed if event_index is passed
+    :param int k: maximal number of samples selected in each event
+    :param labels: None or numpy.array of shape [n_samples] (label, charge), to select top k samples
+        for each label in each event separately
+    :param event_index: precomputed EventIndex for event_ids, optional
+    :return: numpy.array with indices of selected samples, grouped by event (and label), best sample first
+    """
+    if event_index is None:
+        event_index = EventIndex(event_ids)
+    index = event_index
+    if labels is not None:
+        label_values, label_codes = numpy.unique(labels, return_inverse=True)
+        index = EventIndex(event_index.inverse * len(label_values) + label_codes)
+    segments = numpy.repeat(numpy.arange(len(index.counts)), index.counts)
+    values = numpy.asarray(values)
+    sorted_values = values[index.order].astype(float_dtype(values), copy=False)
+    sorted_values[numpy.isnan(sorted_values)] = -numpy.inf
+    selected, ranks = [], []
+    for rank in range(k):
+        maxima = numpy.maximum.reduceat(sorted_values, index.offsets)
+        candidates = numpy.flatnonzero((sorted_values == maxima[segments]) & (sorted_values > -numpy.inf))
+        if len(candidates) == 0:
+            break
+        # first sample with maximal value in each segment
+        first = candidates[numpy.r_[True, segments[candidates[1:]] != segments[candidates[:-1]]]]
+        sorted_values[first] = -numpy.inf
+        selected.append(first)
+        ranks.append(numpy.zeros(len(first), dtype=int) + rank)
+    if len(selected) == 0:
+        return numpy.array([], dtype=int)
+    selected = numpy.concatenate(selected)
+    selected = selected[numpy.lexsort((numpy.concatenate(ranks), segments[selected]))]
+    return index.order[selected]
+
+
+def get_events_statistics(data, id_column='event_id', event_index=None):
+    """
+    :param id_column: column with event id, either string `run_event` or packed int64 key (see `data_cache.pack_event_id`)
+    :param event_index: precomputed EventIndex for data, optional
     :return: dict with 'Events' - number of events and 'tracks' - number of samples
     """
-    return {'Events': len(numpy.unique(data[id_column])), 'tracks': len(data)}
+    event_index = get_event_index(data, id_column, event_index)
+    return {'Events': event_index.n_events, 'tracks': len(data)}
 
 
-def get_events_number(data, id_column='event_id'):
+def get_events_number(data, id_column='event_id', event_index=None):
     """
+    :param id_column: column with event id, either string `run_event` or packed int64 key (see `data_cache.pack_event_id`)
+    :param event_index: precomputed EventIndex for data, optional
     :return: number of B events
     """
-    _, data_ids = numpy.unique(data[id_column], return_inverse=True)
-    weights = numpy.bincount(data_ids, weights=data.N_sig_sw) / numpy.bincount(data_ids)
+    event_index = get_event_index(data, id_column, event_index)
+    weights = numpy.bincount(event_index.inverse, weights=data.N_sig_sw) / event_index.counts
     return numpy.sum(weights)
 
-def get_statevents_number(data, id_column='event_id'):
+def get_statevents_number(data, id_column='event_id', event_index=None):
     """
+    :param event_index: precomputed EventIndex for data, optional
     :return: effective number of B events, (sumw)^2/sumw2
     """
-    _, data_ids = numpy.unique(data[id_column], return_inverse=True)
-    weights = numpy.bincount(data_ids, weights=data.N_sig_sw) / numpy.bincount(data_ids)
+    event_index = get_event_index(data, id_column, event_index)
+    weights = numpy.bincount(event_index.inverse, weights=data.N_sig_sw) / event_index.counts
     sumw = numpy.sum(weights)
     sumw2 = numpy.sum(weights*weights)
     effnum = sumw*sumw/sumw2
@@ -59,6 +219,57 @@ def get_N_B_statevents():
     N_B_decays = 1.1*7.42867714256286621e+05
     return N_B_decays
 
+
+class CutScan(object):
+    """
+    Tagging efficiency for a grid of cuts `(var_1 > t_1) | ... | (var_k > t_k)` on tracks:
+    event is tagged if at least one of its tracks passes the cut.
+    Per-event maxima of variables are computed once, then efficiency for all grid points is obtained from
+    cumulative sums of the weighted histogram of maxima, without filtering data for each point.
+    
+    :param data: pandas.DataFrame with tracks
+    :param variables: list of columns
+    :param base_mask: boolean numpy.array of shape [n_samples], tracks passing preselection
+        (e.g. ghostProb < 0.4), None means all tracks. To scan preselection, create CutScan for each mask.
+    :param weight_column: column for weights in data
+    :param id_column: column with event id
+    :param event_index: precomputed EventIndex for data, optional
+    """
+    def __init__(self, data, variables, base_mask=None, weight_column='N_sig_sw', id_column='event_id',
+                 event_index=None):
+        event_index = get_event_index(data, id_column, event_index)
+        self.variables = list(variables)
+        columns = []
+        for variable in self.variables:
+            values = data[variable].values
+            values = values.astype(float_dtype(values))
+            values[numpy.isnan(values)] = -numpy.inf
+            if base_mask is not None:
+                values[~numpy.asarray(base_mask, dtype=bool)] = -numpy.inf
+            columns.append(values)
+        # maximum over tracks of each event, -inf if no track passes base mask
+        self.maxima = event_index.reduce(columns, numpy.maximum)
+        self.weights = numpy.bincount(event_index.inverse, weights=data[weight_column].values) / event_index.counts
+
+    def efficiency(self, thresholds, N_B=None):
+        """
+        :param thresholds: list of increasing arrays, grid of thresholds for each variable
+        :param N_B: number of B events, by default `get_N_B_events()`
+        :return: tagging efficiency and its error, numpy.arrays of shape [len(thresholds[0]), ..., len(thresholds[k-1])]
+        """
+        assert len(thresholds) == len(self.variables), 'thresholds should be given for each variable'
+        N_B = get_N_B_events() if N_B is None else N_B
+        thresholds = [numpy.asarray(grid, dtype=float) for grid in thresholds]
+        shape = [len(grid) + 1 for grid in thresholds]
+        # event fails thresholds grid[j] with j >= (number of thresholds below its maximum) for all variables
+        indices = [numpy.searchsorted(grid, self.maxima[:, i], side='left') for i, grid in enumerate(thresholds)]
+        failed = numpy.bincount(numpy.ravel_multi_index(indices, shape), weights=self.weights,
+                                minlength=int(numpy.prod(shape))).reshape(shape)
+        for axis in range(len(shape)):
+            failed = numpy.cumsum(failed, axis=axis)
+        N_B_passed = numpy.sum(self.weights) - failed[tuple(slice(0, size - 1) for size in shape)]
+        return N_B_passed / N_B, numpy.sqrt(N_B_passed) / N_B
+
     
 def plot_flattened_probs(probs, labels, weights, label=1, check_input=True):
     """
@@ -90,54 +301,150 @@ def plot_flattened_probs(probs, labels, weights, label=1, check_input=True):
     return flattener
 
 
-def bootstrap_calibrate_prob(labels, weights, probs, n_calibrations=30, group_column=None, threshold=0., symmetrize=False, plot=False):
+# sorted data of the running bootstrap, set in the main process or in pool workers
+_bootstrap_data = {}
+
+
+def _init_bootstrap(data):
+    _bootstrap_data.clear()
+    _bootstrap_data.update(data)
+
+
+def _prepare_bootstrap_data(labels, weights, probs, group_column=None, symmetrize=False):
+    """
+    Sort data for isotonic fit once, all bootstrap replicates take their train part from this order.
+    """
+    data = {'labels': labels, 'weights': weights, 'probs': probs, 'symmetrize': symmetrize}
+    if symmetrize:
+        # folded data, see `SymmetricIsotonicRegression`
+        fit_probs, fit_labels = _fold_symmetric(probs, labels > 0)
+    else:
+        fit_probs, fit_labels = probs, labels
+    fit_weights = weights
+    # the same order as in IsotonicRegression.fit
+    order = numpy.lexsort((fit_labels, fit_probs))
+    data.update({'order': order, 'fit_probs': fit_probs[order], 'fit_labels': fit_labels[order] * 1.,
+                 'fit_weights': fit_weights[order]})
+    if group_column is not None:
+        _, data['group_inverse'] = numpy.unique(group_column, return_inverse=True)
+    return data
+
+
+def _bootstrap_train_mask(seed, data):
+    """
+    Random half of samples (or of groups, if group column is given) used for calibration in bootstrap replicate.
+    """
+    random_state = numpy.random.RandomState(seed)
+    if 'group_inverse' in data:
+        n_groups = data['group_inverse'].max() + 1
+        train_groups = numpy.zeros(n_groups, dtype=bool)
+        train_groups[random_state.permutation(n_groups)[:n_groups // 2]] = True
+        return train_groups[data['group_inverse']]
+    n_samples = len(data['probs'])
+    train = numpy.zeros(n_samples, dtype=bool)
+    train[random_state.permutation(n_samples)[:n_samples // 2]] = True
+    return train
+
+
+def _fit_sorted_isotonic(x, y, w, y_min=0):
+    """
+    Isotonic fit for data sorted by x, samples with equal x are merged.
+    As in IsotonicRegression, x closer than `numpy.finfo(float).resolution` are equal
+    (e.g. p and 1 - (1 - p), which differ by rounding).
+
+    :return: knots x, fitted values in knots
+    """
+    starts = numpy.flatnonzero(numpy.r_[True, x[1:] - x[:-1] >= numpy.finfo(float).resolution])
+    w_sum = numpy.add.reduceat(w, starts)
+    wy_sum = numpy.add.reduceat(w * y, starts)
+    y_mean = numpy.where(w_sum != 0, wy_sum / numpy.where(w_sum != 0, w_sum, 1.), 0.5)
+    return x[starts], isotonic_regression(y_mean, sample_weight=w_sum, y_min=y_min, y_max=1)
+
+
+def _bootstrap_calibration(train, data):
+    """
+    Fit isotonic calibration on train part of data
+
+    :return: knots x, fitted values in knots
+    """
+    fit_train = train[data['order']]
+    knots, fitted = _fit_sorted_isotonic(data['fit_probs'][fit_train], data['fit_labels'][fit_train],
+                                         data['fit_weights'][fit_train], y_min=0.5 if data['symmetrize'] else 0)
+    if data['symmetrize']:
+        return _mirror_symmetric(knots, fitted)
+    return knots, fitted
+
+
+def _bootstrap_replicate(seed):
+    """
+    One bootstrap replicate: calibrate on random half, compute D2 on the other half.
+    """
+    data = _bootstrap_data
+    train = _bootstrap_train_mask(seed, data)
+    knots, fitted = _bootstrap_calibration(train, data)
+    test = ~train
+    # numpy.interp clips out of bounds, as IsotonicRegression(out_of_bounds='clip')
+    probs_calib = numpy.interp(data['probs'][test], knots, fitted)
+    alpha = (1 - 2 * probs_calib) ** 2
+    return numpy.average(alpha, weights=data['weights'][test])
+
+
+def bootstrap_calibrate_prob(labels, weights, probs, n_calibrations=30, group_column=None, threshold=0., symmetrize=False,
+                             plot=False, random_state=None, n_jobs=1):
     """
     Bootstrap isotonic calibration: 
      * randomly divide data into train-test
      * on train isotonic is fitted and applyed to test
      * on test using calibrated probs p(B+) D2 and auc are calculated 
+
+    Data is sorted once for all replicates, replicates are computed in `n_jobs` processes,
+    aucs of all replicates are computed together with `WeightedRoc`.
     
     :param probs: probabilities, numpy.array of shape [n_samples]
     :param labels: numpy.array of shape [n_samples] with labels 
     :param weights: numpy.array of shape [n_samples]
+    :param group_column: numpy.array of shape [n_samples] with group id, if given, groups are not split between train and test
     :param threshold: float, to set labels 0/1 
     :param symmetrize: bool, do symmetric calibration, ex. for B+, B-
+    :param random_state: seed or RandomState, replicate i uses i-th seed drawn from it
+    :param int n_jobs: number of processes
     
     :return: D2 array and auc array
     """
-    aucs = []
-    D2_array = []
-    labels = (labels > threshold) * 1
-    
-    for _ in range(n_calibrations):
-        if group_column is not None:
-            train_probs, test_probs, train_labels, test_labels, train_weights, test_weights = train_test_split_group(
-                group_column, probs, labels, weights, train_size=0.5)
-        else:
-            train_probs, test_probs, train_labels, test_labels, train_weights, test_weights = train_test_split(
-                probs, labels, weights, train_size=0.5)
-        iso_est = IsotonicRegression(y_min=0, y_max=1, out_of_bounds='clip')
-        if symmetrize:
-            train_weights = 0.5*train_weights;
-            iso_est.fit(numpy.r_[train_probs, 1-train_probs], 
-                        numpy.r_[train_labels > 0, train_labels <= 0],
-                        numpy.r_[train_weights, train_weights])
-        else:
-            iso_est.fit(train_probs, train_labels, train_weights)
-            
-        probs_calib = iso_est.transform(test_probs)
+    labels = (numpy.asarray(labels) > threshold) * 1
+    weights, probs = numpy.asarray(weights, dtype=float), numpy.asarray(probs, dtype=float)
+    data = _prepare_bootstrap_data(labels, weights, probs, group_column=group_column, symmetrize=symmetrize)
+    seeds = check_random_state(random_state).randint(0, 2 ** 31 - 1, size=n_calibrations)
 
-        if plot:
-            plt.figure(1,figsize=(6,5))
-            plt.scatter(train_probs, train_labels, color='black', zorder=20)
-            X_test = numpy.linspace(0.001,0.999,500)
-            y_test = iso_est.transform(X_test)
-            plt.plot(X_test, y_test, color='blue', linewidth=3)
-            plt.show()
-
-        alpha = (1 - 2 * probs_calib) ** 2
-        aucs.append(roc_auc_score(test_labels, test_probs, sample_weight=test_weights))
-        D2_array.append(numpy.average(alpha, weights=test_weights))
+    if n_jobs > 1 and not plot:
+        pool = Pool(processes=n_jobs, initializer=_init_bootstrap, initargs=(data,))
+        try:
+            results = pool.map(_bootstrap_replicate, seeds)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        _init_bootstrap(data)
+        results = []
+        for seed in seeds:
+            results.append(_bootstrap_replicate(seed))
+            if plot:
+                train = _bootstrap_train_mask(seed, data)
+                knots, fitted = _bootstrap_calibration(train, data)
+                plt.figure(1,figsize=(6,5))
+                plt.scatter(probs[train], labels[train], color='black', zorder=20)
+                X_test = numpy.linspace(0.001,0.999,500)
+                plt.plot(X_test, numpy.interp(X_test, knots, fitted), color='blue', linewidth=3)
+                plt.show()
+    _bootstrap_data.clear()
+
+    D2_array = list(results)
+    roc = WeightedRoc(labels, probs, order=None if symmetrize else data['order'])
+    aucs = []
+    batch_size = 16
+    for batch_start in range(0, len(seeds), batch_size):
+        test_weights = [weights * ~_bootstrap_train_mask(seed, data) for seed in seeds[batch_start:batch_start + batch_size]]
+        aucs.extend(roc.auc(numpy.array(test_weights)))
     return D2_array, aucs
 
 
@@ -188,177 +495,390 @@ def result_table(tagging_efficiency, tagging_efficiency_delta, D2, auc, name='mo
     return pandas.DataFrame(result)
 
 
-def calibrate_probs(labels, weights, probs, logistic=False, random_state=11, threshold=0., return_calibrator=False, symmetrize=False, inEtaSpace=False, plot=False):
+def calibration_profile(x, y, w, n_bins=250):
     """
-    Calibrate output to probabilities using 2-folding to calibrate all data
+    Binned calibration profile: weighted mean of x and y in quantile bins of x
+    (bins contain equal number of samples, bins with equal edges are merged).
     
-    :param probs: probabilities, numpy.array of shape [n_samples]
-    :param labels: numpy.array of shape [n_samples] with labels 
-    :param weights: numpy.array of shape [n_samples]
-    :param threshold: float, to set labels 0/1 
-    :param logistic: bool, use logistic or isotonic regression
-    :param inEtaSpace: bool, do calibration in eta between 0 and 0.5    
-    :param symmetrize: bool, do symmetric calibration, ex. for B+, B-
+    :param x: numpy.array of shape [n_samples], calibrated variable
+    :param y: numpy.array of shape [n_samples], labels
+    :param w: numpy.array of shape [n_samples], weights
+    :param n_bins: maximal number of bins
+    
+    :return: mean x, mean y and sum of weights for each bin
+    """
+    x = numpy.ravel(x)
+    sorted_x = numpy.sort(x)
+    inner_edges = numpy.unique(sorted_x[(numpy.arange(1, n_bins) * len(x)) // n_bins])
+    # bins are closed from the right, as in pandas.qcut
+    bins = numpy.searchsorted(inner_edges, x, side='left')
+    w_sum = numpy.bincount(bins, weights=w)
+    filled = numpy.bincount(bins) > 0
+    x_mean = numpy.bincount(bins, weights=w * x) / w_sum
+    y_mean = numpy.bincount(bins, weights=w * y) / w_sum
+    return x_mean[filled], y_mean[filled], w_sum[filled]
+
 
-    :return: calibrated probabilities
+def calibration_diagnostics(calibrators, samples, logistic=False, inEtaSpace=False, n_bins=250):
     """
-    labels = (labels > threshold) * 1
-    ind = numpy.arange(len(probs))
-    ind_1, ind_2 = train_test_split(ind, random_state=random_state, train_size=0.5)
+    Calibration curves and binned profiles for calibrators fitted on halves of data (see `calibrate_probs`)
     
-    calibrator = LogisticRegression(C=100,solver='sag') if logistic else IsotonicRegression(y_min=0, y_max=1, out_of_bounds='clip')
-    est_calib_1, est_calib_2 = clone(calibrator), clone(calibrator)
-    probs_1 = probs[ind_1]
-    probs_2 = probs[ind_2]
-    flav_1 = labels[ind_1]
-    flav_2 = labels[ind_2]
-    w1 = weights[ind_1]
-    w2 = weights[ind_2]
-    
-    # Turn 0-1 B+/B- space into 0-0.5 mistagged/tagged space
-    x1 = x2 = y1 = y2 = dllx1 = dllx2 = []
-    dil_1 = 2*probs_1 - 1 # 0 => -1; 0.5 => 0; 1 => 1
-    dil_2 = 2*probs_2 - 1
-    tag_1 = numpy.sign(dil_1) # - => -1; + => +1
-    tag_2 = numpy.sign(dil_2)
-    eta_1 = 0.5*(1-numpy.abs(dil_1)) # 0 => 0; 0.5 => 0.5; 1 => 0
-    eta_2 = 0.5*(1-numpy.abs(dil_2))
-    if False:
-        plt.figure(1,figsize=(6,5))
-        plt.scatter(probs_1,eta_1)
-        plt.show()
+    :param calibrators: list of fitted calibrators (LogisticRegression on logit(x) or IsotonicRegression)
+    :param samples: list of (x, y, w) used to fit each calibrator
     
+    :return: dict with 'x_test' - grid, 'curves' - calibrators output on the grid,
+        'profiles' - `calibration_profile` for each sample, 'samples' - samples themselves
+    """
     if inEtaSpace:
-        x1 = eta_1
-        x2 = eta_2
-        y1 = tag_1 != 2*flav_1-1
-        y2 = tag_2 != 2*flav_2-1
+        X_test = numpy.linspace(0.001,0.499,500)
     else:
-        if symmetrize:
-            x1 = numpy.r_[probs_1, 1-probs_1]
-            x2 = numpy.r_[probs_2, 1-probs_2]
-            y1 = numpy.r_[flav_1 > 0, flav_1 <= 0]
-            y2 = numpy.r_[flav_2 > 0, flav_2 <= 0]
-            w1 = 0.5*w1
-            w2 = 0.5*w2
-            w1 = numpy.r_[w1,w1]
-            w2 = numpy.r_[w2,w2]
-        else:
-            x1 = probs_1
-            x2 = probs_2
-            y1 = flav_1>0
-            y2 = flav_2>0
+        X_test = numpy.linspace(0.001,0.999,500)
+    if logistic:
+        dllX_test = logit(X_test)[:, numpy.newaxis]
+        curves = [calibrator.predict_proba(dllX_test)[:, 1] for calibrator in calibrators]
+    else:
+        curves = [calibrator.transform(X_test) for calibrator in calibrators]
+    profiles = [calibration_profile(x, y, w, n_bins=n_bins) for x, y, w in samples]
+    return {'x_test': X_test, 'curves': curves, 'profiles': profiles, 'samples': samples}
+
+
+def plot_calibration_diagnostics(diagnostics):
+    """
+    Plot output of `calibration_diagnostics`: samples, binned profile and calibration curve for each half of data.
+    """
+    n_parts = len(diagnostics['curves'])
+    plt.figure(1,figsize=(6 * n_parts,5))
+    for index, ((x, y, _), (x_mean, y_mean, _), curve) in enumerate(zip(diagnostics['samples'], diagnostics['profiles'],
+                                                                     diagnostics['curves'])):
+        plt.subplot(1,n_parts,index + 1)
+        plt.scatter(numpy.ravel(x), y, color='black', zorder=20)
+        plt.scatter(x_mean, y_mean, color='red', zorder=20)
+        plt.plot(diagnostics['x_test'], curve, color='blue', linewidth=3)
+    plt.show()
+
+
+def _fold_symmetric(probs, labels):
+    """
+    Fold data for calibration symmetric under p <-> 1 - p.
+
+    :return: q = max(p, 1 - p) and label of correct tag (0.5 for p = 0.5)
+    """
+    probs, labels = numpy.asarray(probs, dtype=float), numpy.asarray(labels, dtype=float)
+    return numpy.maximum(probs, 1 - probs), numpy.where(probs > 0.5, labels, numpy.where(probs < 0.5, 1 - labels, 0.5))
+
+
+def _mirror_symmetric(knots, values):
+    """
+    Table of symmetric calibration on [0.5, 1] -> table on [0, 1] using f(1 - p) = 1 - f(p) and f(0.5) = 0.5
+    """
+    upper = knots > 0.5
+    knots, values = knots[upper], values[upper]
+    return numpy.r_[1 - knots[::-1], 0.5, knots], numpy.r_[1 - values[::-1], 0.5, values]
+
+
+class SymmetricIsotonicRegression(object):
+    """
+    Isotonic calibration p -> p(B+) symmetric under p <-> 1 - p without duplicating data.
+    Isotonic regression on data with every sample added also as (1 - p, opposite label, half weights)
+    is symmetric, so it is fitted on the folded data q = max(p, 1 - p) (label is 1 if tag is correct)
+    with lower bound 0.5 and then mirrored. Result is the same, but with half of memory and sorting.
+    """
+    def fit(self, x, y, sample_weight=None):
+        q, z = _fold_symmetric(x, y)
+        w = numpy.ones(len(q)) if sample_weight is None else numpy.asarray(sample_weight, dtype=float)
+        # the same order as in IsotonicRegression.fit
+        order = numpy.lexsort((z, q))
+        knots, values = _fit_sorted_isotonic(q[order], z[order], w[order], y_min=0.5)
+        self.knots_, self.values_ = _compact_table(*_mirror_symmetric(knots, values))
+        return self
+
+    def transform(self, x):
+        # numpy.interp clips out of bounds, as IsotonicRegression(out_of_bounds='clip')
+        return numpy.interp(x, self.knots_, self.values_)
 
-            
-    ## If logistic regression, change x to logit(x)
+
+def _calibration_estimator(logistic, symmetric):
+    """
+    New calibration estimator for `calibrate_probs`, symmetric estimators are fitted on not duplicated data.
+    """
     if logistic:
-        if inEtaSpace:
-              x1 = numpy.clip(x1, 0.00001, 0.49999)
-              x2 = numpy.clip(x2, 0.00001, 0.49999)
+        # logistic regression on data symmetrized by duplication has zero intercept,
+        # its slope is the same as of the fit without intercept on the original data
+        return LogisticRegression(C=100, solver='sag', fit_intercept=not symmetric)
+    if symmetric:
+        return SymmetricIsotonicRegression()
+    return IsotonicRegression(y_min=0, y_max=1, out_of_bounds='clip')
+
+
+def _compact_table(knots, values):
+    """
+    Remove knots inside runs of equal values, piecewise-linear interpolation of the table does not change.
+    """
+    constant = values[1:] == values[:-1]
+    keep = ~(numpy.r_[False, constant] & numpy.r_[constant, False])
+    return knots[keep], values[keep]
+
+
+def _npz_path(path):
+    """
+    :return: path with `.npz` suffix, as `numpy.savez` appends it to the file name
+    """
+    return path if path.endswith('.npz') else path + '.npz'
+
+
+class Calibrator(object):
+    """
+    Compiled calibration p -> calibrated p(B+): piecewise-linear lookup table applied with one `numpy.interp` call.
+    Outside of the table values are clipped. Only ends of constant parts are kept in the table
+    (isotonic calibration has few steps).
+
+    :param knots: increasing numpy.array, points where table is defined
+    :param values: numpy.array, calibrated values in knots
+    :param inEtaSpace: bool, table is defined for mistag eta = min(p, 1 - p), result is turned back to p(B+) using tag sign
+    """
+    def __init__(self, knots, values, inEtaSpace=False):
+        self.knots, self.values = _compact_table(numpy.asarray(knots, dtype=float), numpy.asarray(values, dtype=float))
+        self.inEtaSpace = bool(inEtaSpace)
+
+    @classmethod
+    def from_estimator(cls, estimator, x, logistic=False, inEtaSpace=False, n_knots=2001):
+        """
+        Compile estimator fitted in `calibrate_probs`.
+        Isotonic regression is exactly tabulated in unique train points (only ends of its steps are kept),
+        logistic regression (on logit of clipped x) is tabulated on a grid uniform in logit(x).
+
+        :param estimator: fitted IsotonicRegression, SymmetricIsotonicRegression or LogisticRegression
+        :param x: train points (before logit transformation)
+        :param n_knots: size of the grid for logistic regression
+        """
+        if isinstance(estimator, SymmetricIsotonicRegression):
+            return cls(estimator.knots_, estimator.values_, inEtaSpace=inEtaSpace)
+        if logistic:
+            x_max = 0.49999 if inEtaSpace else 0.99999
+            knots = expit(numpy.linspace(logit(0.00001), logit(x_max), n_knots))
+            values = estimator.predict_proba(logit(knots)[:, numpy.newaxis])[:, 1]
         else:
-              x1 = numpy.clip(x1, 0.00001, 0.99999)
-              x2 = numpy.clip(x2, 0.00001, 0.99999)
-        dllx1 = logit(x1)[:, numpy.newaxis]
-        dllx2 = logit(x2)[:, numpy.newaxis]
-    
-    # Do the fit
+            knots = numpy.unique(x)
+            values = estimator.transform(knots)
+        return cls(knots, values, inEtaSpace=inEtaSpace)
+
+    @classmethod
+    def average(cls, calibrators):
+        """
+        Calibrator, which returns average output of calibrators (e.g. of folds)
+        """
+        inEtaSpace = calibrators[0].inEtaSpace
+        assert all(calibrator.inEtaSpace == inEtaSpace for calibrator in calibrators), 'different calibration spaces'
+        knots = numpy.unique(numpy.concatenate([calibrator.knots for calibrator in calibrators]))
+        values = numpy.mean([numpy.interp(knots, calibrator.knots, calibrator.values) for calibrator in calibrators], axis=0)
+        return cls(knots, values, inEtaSpace=inEtaSpace)
+
+    def transform(self, probs):
+        """
+        :param probs: p(B+) probabilities, numpy.array of shape [n_samples]
+        :return: calibrated p(B+)
+        """
+        probs = numpy.asarray(probs)
+        if not self.inEtaSpace:
+            return numpy.interp(probs, self.knots, self.values)
+        mistag = numpy.interp(numpy.minimum(probs, 1 - probs), self.knots, self.values)
+        return numpy.where(probs > 0.5, 1 - mistag, numpy.where(probs < 0.5, mistag, 0.5))
+
+    def save(self, path):
+        """
+        Save calibrator to a numpy `.npz` file (suffix is added to path if missing)
+        """
+        numpy.savez(_npz_path(path), knots=self.knots, values=self.values, inEtaSpace=self.inEtaSpace)
+
+    @classmethod
+    def load(cls, path):
+        with numpy.load(_npz_path(path)) as stored:
+            return cls(stored['knots'], stored['values'], inEtaSpace=bool(stored['inEtaSpace']))
+
+
+# calibration variants of p(B+): name -> (logistic, inEtaSpace)
+CALIBRATION_VARIANTS = OrderedDict([('logistic', (True, True)),
+                                    ('isotonic', (False, True)),
+                                    ('B+/B- logistic', (True, False)),
+                                    ('B+/B- isotonic', (False, False))])
+
+
+def _split_calibration_data(labels, weights, probs, random_state=11, threshold=0.):
+    """
+    Split data into two halves for 2-folding calibration, the split is shared by calibration variants.
+    """
+    labels = (numpy.asarray(labels) > threshold) * 1
+    weights, probs = numpy.asarray(weights), numpy.asarray(probs)
+    ind = numpy.arange(len(probs))
+    ind_1, ind_2 = train_test_split(ind, random_state=random_state, train_size=0.5)
+    halves = []
+    for ind_half in [ind_1, ind_2]:
+        dil = 2 * probs[ind_half] - 1 # 0 => -1; 0.5 => 0; 1 => 1
+        halves.append({'index': ind_half, 'probs': probs[ind_half], 'flav': labels[ind_half],
+                       'w': weights[ind_half],
+                       'tag': numpy.sign(dil), # - => -1; + => +1
+                       'eta': 0.5 * (1 - numpy.abs(dil))}) # 0 => 0; 0.5 => 0.5; 1 => 0
+    return {'n_samples': len(probs), 'weights': weights, 'halves': halves, 'inputs': {}}
+
+
+def _calibration_inputs(split, logistic, inEtaSpace):
+    """
+    Train samples (x, y, w) of calibration for each half of data, computed once for each space and memoized in split.
+    Symmetric calibrations use the same samples (see `_calibration_estimator`).
+    For logistic regression x is clipped and `dll` = logit(x) is added.
+    """
+    key = (logistic, inEtaSpace)
+    if key in split['inputs']:
+        return split['inputs'][key]
     if logistic:
-        est_calib_1.fit(dllx1,y1,sample_weight=w1)
-        est_calib_2.fit(dllx2,y2,sample_weight=w2)
+        x_max = 0.49999 if inEtaSpace else 0.99999
+        inputs = []
+        for sample in _calibration_inputs(split, False, inEtaSpace):
+            x = numpy.clip(sample['x'], 0.00001, x_max)
+            inputs.append({'x': x, 'y': sample['y'], 'w': sample['w'], 'dll': logit(x)[:, numpy.newaxis]})
+    elif inEtaSpace:
+        # Turn 0-1 B+/B- space into 0-0.5 mistagged/tagged space
+        inputs = [{'x': half['eta'], 'y': half['tag'] != 2 * half['flav'] - 1, 'w': half['w']}
+                  for half in split['halves']]
     else:
-        est_calib_1.fit(x1,y1,w1)
-        est_calib_2.fit(x2,y2,w2)
-        
-    # Plots
-    if plot:
-        X_test = []
-        if inEtaSpace:
-            X_test = numpy.linspace(0.001,0.499,500)
+        inputs = [{'x': half['probs'], 'y': half['flav'] > 0, 'w': half['w']} for half in split['halves']]
+    split['inputs'][key] = inputs
+    return inputs
+
+
+def _fit_calibration(split, logistic, inEtaSpace, symmetrize):
+    """
+    Fit calibration on each half of split and predict the other half.
+
+    :return: calibrated probabilities, D2, fitted estimators
+    """
+    inputs = _calibration_inputs(split, logistic, inEtaSpace)
+    # calibration in eta space is symmetric itself
+    estimators = [_calibration_estimator(logistic, symmetrize and not inEtaSpace) for _ in inputs]
+    for estimator, sample in zip(estimators, inputs):
+        if logistic:
+            estimator.fit(sample['dll'], sample['y'], sample_weight=sample['w'])
         else:
-            X_test = numpy.linspace(0.001,0.999,500)
-            
-        c1 = c2 = []
+            estimator.fit(sample['x'], sample['y'], sample['w'])
+
+    # Cross validate: each half is predicted by calibration fitted on the other half
+    calibrated_probs = numpy.zeros(split['n_samples'])
+    for half, sample, estimator in zip(split['halves'], inputs, estimators[::-1]):
         if logistic:
-            dllX_test = logit(X_test)[:, numpy.newaxis]
-            c1 = est_calib_1.predict_proba(dllX_test)[:, 1]
-            c2 = est_calib_2.predict_proba(dllX_test)[:, 1]
+            p = estimator.predict_proba(sample['dll'])[:, 1]
         else:
-            c1 = est_calib_1.transform(X_test)
-            c2 = est_calib_2.transform(X_test)
-                
-        tryN = 250
-
-        X1 = x1.ravel()
-        N = tryN
-        groups1 = None
-        success = False
-        while not success:
-            try:
-                groups1 = pandas.qcut(X1,N,range(N))
-                success = True
-            except ValueError:
-                N -= 1
-        plotd1 = pandas.DataFrame({'X' : numpy.multiply(X1,w1), 'g' : groups1, 'y' : numpy.multiply(y1,w1), 'w' : w1 })
-        grouped1 = plotd1.groupby('g')
-        gsum1 = grouped1.sum()
-        gsum1['X'] = gsum1['X'] / gsum1['w']
-        gsum1['y'] = gsum1['y'] / gsum1['w']
-
-        X2 = x2.ravel()
-        N = tryN
-        groups2 = None
-        success = False
-        while not success:
-            try:
-                groups2 = pandas.qcut(X2,N,range(N))
-                success = True
-            except ValueError:
-                N -= 1
-        plotd2 = pandas.DataFrame({'X' : numpy.multiply(X2,w2), 'g' : groups2, 'y' : numpy.multiply(y2,w2), 'w' : w2 })
-        grouped2 = plotd2.groupby('g')
-        gsum2 = grouped2.sum()
-        gsum2['X'] = gsum2['X'] / gsum2['w']
-        gsum2['y'] = gsum2['y'] / gsum2['w']
-
-        plt.figure(1,figsize=(12,5))
-        plt.subplot(1,2,1)
-        plt.scatter(x1.ravel(), y1, color='black', zorder=20)
-        plt.scatter(gsum1['X'], gsum1['y'], color='red', zorder=20)
-        plt.plot(X_test, c1, color='blue', linewidth=3)
-        plt.subplot(1,2,2)
-        plt.scatter(x2.ravel(), y2, color='black', zorder=20)
-        plt.scatter(gsum2['X'], gsum2['y'], color='red', zorder=20)
-        plt.plot(X_test, c2, color='blue', linewidth=3)
-        plt.show()
-    
-    # Cross validate
-    p1 = p2 = []
-    if logistic:
-        p1 = est_calib_2.predict_proba(dllx1)[:, 1]
-        p2 = est_calib_1.predict_proba(dllx2)[:, 1]
-    else:
-        p1 = est_calib_2.transform(x1)
-        p2 = est_calib_1.transform(x2)
+            p = estimator.transform(sample['x'])
+        # Transform back to flav space
+        if inEtaSpace:
+            p = 0.5 * (1 + (1 - 2 * p) * half['tag'])
+        calibrated_probs[half['index']] = p
 
-    # Transform back to flav space
-    if inEtaSpace:
-        pdil_1 = (1-2*p1)*tag_1
-        pdil_2 = (1-2*p2)*tag_2
-        p1 = 0.5*(1+pdil_1)
-        p2 = 0.5*(1+pdil_2)
+    alpha = (1 - 2 * calibrated_probs) ** 2
+    D2 = numpy.average(alpha, weights=split['weights'])
+    return calibrated_probs, D2, estimators
 
-    # Save
-    calibrated_probs = numpy.zeros(len(probs))
-    calibrated_probs[ind_1] = p1
-    calibrated_probs[ind_2] = p2
 
-    # Return
-    alpha = (1 - 2 * calibrated_probs) ** 2
-    D2 = numpy.average(alpha,weights=weights)
+def _compile_calibrators(estimators, inputs, logistic, inEtaSpace):
+    return tuple(Calibrator.from_estimator(estimator, sample['x'], logistic=logistic, inEtaSpace=inEtaSpace)
+                 for estimator, sample in zip(estimators, inputs))
+
+
+def _calibration_diagnostics(estimators, inputs, logistic, inEtaSpace):
+    return calibration_diagnostics(estimators, [(sample['x'], sample['y'], sample['w']) for sample in inputs],
+                                   logistic=logistic, inEtaSpace=inEtaSpace)
+
+
+def calibrate_probs(labels, weights, probs, logistic=False, random_state=11, threshold=0., return_calibrator=False, symmetrize=False, inEtaSpace=False, plot=False,
+                    return_diagnostics=False):
+    """
+    Calibrate output to probabilities using 2-folding to calibrate all data
+    
+    :param probs: probabilities, numpy.array of shape [n_samples]
+    :param labels: numpy.array of shape [n_samples] with labels 
+    :param weights: numpy.array of shape [n_samples]
+    :param threshold: float, to set labels 0/1 
+    :param logistic: bool, use logistic or isotonic regression
+    :param inEtaSpace: bool, do calibration in eta between 0 and 0.5    
+    :param symmetrize: bool, do symmetric calibration, ex. for B+, B-
+    :param plot: bool, plot calibration curves and binned calibration profiles of both halves
+    :param return_diagnostics: bool, return also diagnostics dict (see `calibration_diagnostics`) without plotting
+
+    :return: calibrated probabilities, D2, [calibrators], [diagnostics],
+        calibrators are `Calibrator` for each half of data (fitted on this half)
+    """
+    split = _split_calibration_data(labels, weights, probs, random_state=random_state, threshold=threshold)
+    calibrated_probs, D2, estimators = _fit_calibration(split, logistic, inEtaSpace, symmetrize)
+    inputs = _calibration_inputs(split, logistic, inEtaSpace)
+
+    # Diagnostics and plots
+    diagnostics = None
+    if plot or return_diagnostics:
+        diagnostics = _calibration_diagnostics(estimators, inputs, logistic, inEtaSpace)
+    if plot:
+        plot_calibration_diagnostics(diagnostics)
+
+    result = (calibrated_probs, D2)
     if return_calibrator:
-        return calibrated_probs, D2, (est_calib_1, est_calib_2)
-    else:
-        return calibrated_probs, D2
+        result += (_compile_calibrators(estimators, inputs, logistic, inEtaSpace), )
+    if return_diagnostics:
+        result += (diagnostics, )
+    return result
+
+
+def calibrate_probs_variants(labels, weights, probs, variants=None, random_state=11, threshold=0., symmetrize=False,
+                             plot=False, n_threads=None):
+    """
+    Several calibrations of the same data (see `calibrate_probs`) with one train/test split:
+    the split, symmetrized samples and logit transformations are computed once and shared by variants,
+    variants are fitted concurrently in threads. Fit time of each variant is recorded by `instrumentation`.
+
+    :param probs: probabilities, numpy.array of shape [n_samples]
+    :param labels: numpy.array of shape [n_samples] with labels
+    :param weights: numpy.array of shape [n_samples]
+    :param variants: OrderedDict name -> (logistic, inEtaSpace), by default `CALIBRATION_VARIANTS`
+    :param threshold: float, to set labels 0/1
+    :param symmetrize: bool, do symmetric calibration, ex. for B+, B-
+    :param plot: bool, plot calibration curves and binned calibration profiles for each variant
+    :param n_threads: number of threads, None means one thread per variant
+
+    :return: pandas.DataFrame with `logistic`, `inEtaSpace` and `D2` for each variant (indexed by name),
+        OrderedDict name -> calibrated probabilities, OrderedDict name -> calibrators (`Calibrator` for each half)
+    """
+    variants = CALIBRATION_VARIANTS if variants is None else variants
+    split = _split_calibration_data(labels, weights, probs, random_state=random_state, threshold=threshold)
+    # shared inputs are prepared before threads start
+    for logistic, inEtaSpace in variants.values():
+        _calibration_inputs(split, logistic, inEtaSpace)
+
+    def fit(variant):
+        logistic, inEtaSpace = variant
+        start = time.time()
+        calibrated_probs, D2, estimators = _fit_calibration(split, logistic, inEtaSpace, symmetrize)
+        inputs = _calibration_inputs(split, logistic, inEtaSpace)
+        diagnostics = _calibration_diagnostics(estimators, inputs, logistic, inEtaSpace) if plot else None
+        calibrators = _compile_calibrators(estimators, inputs, logistic, inEtaSpace)
+        return calibrated_probs, D2, calibrators, diagnostics, time.time() - start
+
+    pool = ThreadPool(processes=n_threads or len(variants))
+    try:
+        results = pool.map(fit, list(variants.values()))
+    finally:
+        pool.close()
+        pool.join()
+
+    table = OrderedDict([('logistic', []), ('inEtaSpace', []), ('D2', [])])
+    all_probs, all_calibrators = OrderedDict(), OrderedDict()
+    for (name, (logistic, inEtaSpace)), (calibrated_probs, D2, calibrators, diagnostics, spent_time) in \
+            zip(variants.items(), results):
+        instrumentation.record('calibrate {}'.format(name), spent_time, rows=split['n_samples'])
+        table['logistic'].append(logistic)
+        table['inEtaSpace'].append(inEtaSpace)
+        table['D2'].append(D2)
+        all_probs[name] = calibrated_probs
+        all_calibrators[name] = calibrators
+        if plot:
+            plot_calibration_diagnostics(diagnostics)
+    return pandas.DataFrame(table, index=list(variants.keys())), all_probs, all_calibrators
 
 
 def calculate_auc_with_and_without_untag_events(Bsign, Bprobs, Bweights):
@@ -372,18 +892,31 @@ def calculate_auc_with_and_without_untag_events(Bsign, Bprobs, Bweights):
     :return: auc, full auc
     """
     N_B_not_passed = get_N_B_events() - sum(Bweights)
-    Bsign_not_passed = [-1, 1]
-    Bprobs_not_passed = [0.5] * 2
-    Bweights_not_passed = [N_B_not_passed / 2.] * 2
-    
-    auc_full = roc_auc_score(union(Bsign, Bsign_not_passed), union(Bprobs, Bprobs_not_passed),
-                             sample_weight=union(Bweights, Bweights_not_passed))
-    auc = roc_auc_score(Bsign, Bprobs, sample_weight=Bweights)
+    roc = WeightedRoc(Bsign, Bprobs)
+    # untag events are added as B+ and B- with p(B+) = 0.5
+    auc_full = roc.auc(Bweights, extra_positive=N_B_not_passed / 2., extra_negative=N_B_not_passed / 2.)
+    auc = roc.auc(Bweights)
     return auc, auc_full
 
 
+def _normed_sign_weights(signB, sign_part):
+    """
+    Weights for parts with sign +1, which equalize total number of parts with signs +1 and -1 for each sign of B.
+    """
+    valid = (signB == 1) | (signB == -1)
+    # codes: 0 - (B-, part-), 1 - (B-, part+), 2 - (B+, part-), 3 - (B+, part+)
+    codes = 2 * (signB == 1) + (sign_part == 1)
+    counts = numpy.bincount(codes[valid], minlength=4)
+    factors = numpy.ones(4)
+    for code in [1, 3]:
+        if counts[code] > 0:
+            factors[code] = counts[code - 1] * 1. / counts[code]
+    return numpy.where(valid, factors[codes], 1.)
+
+
 def compute_B_prob_using_part_prob(data, probs, weight_column='N_sig_sw', event_id_column='event_id', signB_column='signB',
-                                   sign_part_column='signTrack', normed_signs=False):
+                                   sign_part_column='signTrack', normed_signs=False, event_index=None,
+                                   dtype=None):
     """
     Compute p(B+) using probs for parts of event (tracks/vertices).
     
@@ -393,23 +926,26 @@ def compute_B_prob_using_part_prob(data, probs, weight_column='N_sig_sw', event_
     :param event_id_column: column for event id in data
     :param signB_column: column for event B sign in data
     :param sign_part_column: column for part sign in data
+    :param event_index: precomputed EventIndex for data, optional
+    :param dtype: dtype of computations, numpy.float32 is faster and uses half of memory;
+        None means the dtype of probs (float32 probs are not upcast)
     
     :return: B sign array, B weight array, B+ prob array, B event id
     """
-    result_event_id, data_ids = numpy.unique(data[event_id_column].values, return_inverse=True)
-    log_probs = numpy.log(probs) - numpy.log(1 - probs)
-    sign_weights = numpy.ones(len(log_probs))
+    event_index = get_event_index(data, event_id_column, event_index)
+    probs = numpy.asarray(probs)
+    dtype = float_dtype(probs) if dtype is None else dtype
+    probs = probs.astype(dtype, copy=False)
+    sign_part = data[sign_part_column].values
+    log_probs = numpy.log(probs / (1 - probs))
+    log_probs *= sign_part
     if normed_signs:
-        for sign in [-1, 1]:
-            maskB = (data[signB_column].values == sign)
-            maskPart = (data[sign_part_column].values == 1)
-            sign_weights[maskB * maskPart] *= sum(maskB * (~maskPart)) * 1. /  sum(maskB * maskPart)
-    log_probs *= sign_weights * data[sign_part_column].values
-    result_logprob = numpy.bincount(data_ids, weights=log_probs)
-    # simply reconstructing original
-    result_label = numpy.bincount(data_ids, weights=data[signB_column].values) / numpy.bincount(data_ids)
-    result_weight = numpy.bincount(data_ids, weights=data[weight_column]) / numpy.bincount(data_ids)
-    return result_label, result_weight, expit(result_logprob), result_event_id
+        log_probs *= _normed_sign_weights(data[signB_column].values, sign_part)
+    # all per-event sums in one pass, label and weight are the same for all parts of the event
+    sums = event_index.reduce([log_probs, data[signB_column].values, data[weight_column].values], dtype=dtype)
+    result_label = sums[:, 1] / event_index.counts
+    result_weight = sums[:, 2] / event_index.counts
+    return result_label, result_weight, expit(sums[:, 0]), event_index.event_ids
 
 
 def get_B_data_for_given_part(estimator, datasets, logistic=True, inEtaSpace=False, sign_part_column='signTrack', part_name='track',
@@ -427,9 +963,11 @@ def get_B_data_for_given_part(estimator, datasets, logistic=True, inEtaSpace=Fal
     :return: B sign, weight, p(B+), event id and full auc (with untag events) 
     """
     # Calibration p(track/vertex same sign|B)
-    data_calib, part_probs = predict_by_estimator(estimator, datasets)
-    part_probs_calib, D2 = calibrate_probs(data_calib.label.values, data_calib.N_sig_sw.values, part_probs, 
-                                       logistic=logistic, inEtaSpace=inEtaSpace, random_state=random_state)
+    with instrumentation.stage('predict {}s'.format(part_name), rows=sum(len(dataset) for dataset in datasets)):
+        data_calib, part_probs = predict_by_estimator(estimator, datasets)
+    with instrumentation.stage('calibrate {}s'.format(part_name), rows=len(part_probs)):
+        part_probs_calib, D2 = calibrate_probs(data_calib.label.values, data_calib.N_sig_sw.values, part_probs, 
+                                           logistic=logistic, inEtaSpace=inEtaSpace, random_state=random_state)
 
     plt.figure(figsize=[18, 5])
     plt.subplot(1,3,1)
@@ -442,11 +980,14 @@ def get_B_data_for_given_part(estimator, datasets, logistic=True, inEtaSpace=Fal
     plt.hist(part_probs_calib[data_calib.label.values == 1], bins=60, normed=True, alpha=0.3, label='ss')
     plt.legend(), plt.title('{} probs calibrated'.format(part_name))
         
-    all_events = get_events_statistics(data_calib)['Events']
+    event_index = get_event_index(data_calib)
+    all_events = get_events_statistics(data_calib, event_index=event_index)['Events']
     
     # Compute p(B+)
-    Bsign, Bweight, Bprob, Bevent = compute_B_prob_using_part_prob(data_calib, part_probs_calib, 
-                                                                   sign_part_column=sign_part_column, normed_signs=normed_signs)
+    with instrumentation.stage('compute B probs', rows=len(data_calib)):
+        Bsign, Bweight, Bprob, Bevent = compute_B_prob_using_part_prob(data_calib, part_probs_calib, 
+                                                                       sign_part_column=sign_part_column, normed_signs=normed_signs,
+                                                                       event_index=event_index)
     Bprob[~numpy.isfinite(Bprob)] = 0.5
     Bprob[numpy.isnan(Bprob)] = 0.5
     
@@ -464,7 +1005,7 @@ def get_B_data_for_given_part(estimator, datasets, logistic=True, inEtaSpace=Fal
 def get_result_with_bootstrap_for_given_part(tagging_efficiency, tagging_efficiency_delta, estimator,
                                              datasets, name, logistic=True, inEtaSpace=False, n_calibrations=30,
                                              sign_part_column='signTrack', part_name='track',
-                                             random_state=11, normed_signs=False):
+                                             random_state=11, normed_signs=False, plot=False):
     """
     Predict probabilities for event parts, calibrate it, compute B data and estimate with bootstrap (calibration p(B+)) D2
     
@@ -477,23 +1018,23 @@ def get_result_with_bootstrap_for_given_part(tagging_efficiency, tagging_efficie
     :param inEtaSpace: bool, do calibration in eta between 0 and 0.5
     :param sign_part_column: column for part sign in data
     :param part_name: part data name for plots 
+    :param plot: bool, plot calibration curves of p(B+) (see `calibrate_probs_variants`)
     
     :return: pandas.DataFrame with only one row, describing result_table
+
+    Use `instrumentation.Recorder` to get time and memory of each stage.
     """
     Bsign, Bweight, Bprob, Bevent, auc_full = get_B_data_for_given_part(estimator, datasets, logistic=logistic, inEtaSpace=inEtaSpace,
                                                                         sign_part_column=sign_part_column, 
                                                                         part_name=part_name, random_state=random_state,
                                                                         normed_signs=normed_signs)    
     # Compute p(B+) calibrated with bootstrap
-    _, D2log = calibrate_probs(Bsign, Bweight, Bprob, logistic=True,inEtaSpace=True,symmetrize=True,plot=True)
-    print 'D2 using logistic calibration: ', D2log
-    _, D2iso = calibrate_probs(Bsign, Bweight, Bprob, logistic=False,inEtaSpace=True,symmetrize=True,plot=True)
-    print 'D2 using isotonic calibration: ', D2iso
-    _, D2log = calibrate_probs(Bsign, Bweight, Bprob, logistic=True,inEtaSpace=False,symmetrize=True,plot=True)
-    print 'D2 using B+/- logistic calibration: ', D2log
-    _, D2iso = calibrate_probs(Bsign, Bweight, Bprob, logistic=False,inEtaSpace=False,symmetrize=True,plot=True)
-    print 'D2 using B+/B- isotonic calibration: ', D2iso
-    D2, aucs = bootstrap_calibrate_prob(Bsign, Bweight, Bprob, n_calibrations=30,plot=False)
+    with instrumentation.stage('calibrate B', rows=len(Bprob)):
+        D2_table, _, _ = calibrate_probs_variants(Bsign, Bweight, Bprob, symmetrize=True, plot=plot)
+    for variant, D2_variant in D2_table['D2'].items():
+        print 'D2 using {} calibration: '.format(variant), D2_variant
+    with instrumentation.stage('bootstrap', rows=len(Bprob), n_calibrations=n_calibrations):
+        D2, aucs = bootstrap_calibrate_prob(Bsign, Bweight, Bprob, n_calibrations=n_calibrations,plot=False)
     print 'bootstrap mean D2 after calibration:', numpy.mean(D2), numpy.var(aucs)
     print 'bootstrap mean AUC after calibration:', numpy.mean(aucs), numpy.var(aucs)
     return result_table(tagging_efficiency, tagging_efficiency_delta, D2, auc_full, name)
@@ -521,7 +1062,7 @@ def prepare_B_data_for_given_part(estimator, datasets, logistic=True, inEtaSpace
                                                                         part_name=part_name, random_state=random_state,
                                                                         normed_signs=normed_signs)    
     # Roc curve
-    fpr, tpr, _ = roc_curve(Bsign, Bprob, sample_weight=Bweight)
+    fpr, tpr, _ = WeightedRoc(Bsign, Bprob).roc_curve(Bweight)
     plt.plot(fpr, tpr)
     plt.plot([0, 1], [0, 1], 'k--')
     plt.ylim(0, 1), plt.xlim(0, 1), plt.show()
@@ -532,6 +1073,164 @@ def prepare_B_data_for_given_part(estimator, datasets, logistic=True, inEtaSpace
     return Bdata_prepared
 
 
+RELATION_PROB_SUFFIX = '_relation_prob'
+
+
+def save_B_data(path, Bdata):
+    """
+    Save B data (result of `prepare_B_data_for_given_part`) in numpy binary format instead of csv.
+
+    :param path: path to .npz file (suffix is added if missing)
+    :param Bdata: pandas.DataFrame
+    """
+    numpy.savez(_npz_path(path), **{column: Bdata[column].values for column in Bdata.columns})
+
+
+def load_B_data(path):
+    """
+    Load B data saved by `save_B_data`.
+
+    :return: pandas.DataFrame
+    """
+    with numpy.load(_npz_path(path)) as stored:
+        return pandas.DataFrame(OrderedDict((column, stored[column]) for column in stored.files))
+
+
+def combine_taggers(parts):
+    """
+    Combine B data of several taggers (for instance, track-based and vertex-based) into one tagger.
+    Parts are aligned by event id with sorted index, events absent in a part get
+    neutral relation p(B+) / (1 - p(B+)) = 1 for this part, then p(B+) = prod / (1 + prod).
+
+    :param parts: list of pandas.DataFrames from `prepare_B_data_for_given_part` with keys
+        `event_id`, `Bsign`, `Bweight`, `{part_name}_relation_prob`
+    :return: pandas.DataFrame with keys `event_id`, `Bsign`, `Bweight`, relation probs of all parts
+        (1 for missing events) and combined `Bprob`
+    """
+    event_ids = numpy.unique(numpy.concatenate([part['event_id'].values for part in parts]))
+    Bsign = numpy.zeros(len(event_ids))
+    Bweight = numpy.zeros(len(event_ids))
+    found = numpy.zeros(len(event_ids), dtype=bool)
+    log_relation = numpy.zeros(len(event_ids))
+    relations = OrderedDict()
+    for part in parts:
+        positions = numpy.searchsorted(event_ids, part['event_id'].values)
+        # B sign and weight are the same in all parts, take them from the first part containing the event
+        new = ~found[positions]
+        Bsign[positions[new]] = part['Bsign'].values[new]
+        Bweight[positions[new]] = part['Bweight'].values[new]
+        found[positions] = True
+        for column in part.columns:
+            if column.endswith(RELATION_PROB_SUFFIX):
+                relation = numpy.ones(len(event_ids))
+                relation[positions] = part[column].values
+                relations[column] = relation
+                log_relation[positions] += numpy.log(part[column].values)
+    result = OrderedDict([('event_id', event_ids), ('Bsign', Bsign), ('Bweight', Bweight)])
+    result.update(relations)
+    result['Bprob'] = expit(log_relation)
+    return pandas.DataFrame(result)
+
+
+def mistag_tables(Bprobs, Bsign, Bweight, selections, binnings, n_bootstrap=0, random_state=None):
+    """
+    Tables of true mistag vs mistag probability for several selections of B events and several binnings at once.
+    Samples are binned with one searchsorted (against the union of all edges) and counted
+    with one weighted bincount over (selection pattern, bin, tag correctness).
+    
+    :param Bprobs: p(B+) probabilities, numpy.array of shape [n_samples]
+    :param Bsign: numpy.array of shape [n_samples] with labels {-1, 1}
+    :param Bweight: numpy.array of shape [n_samples]
+    :param selections: OrderedDict {name: boolean mask of shape [n_samples]}, e.g. all B, B+, B-
+    :param binnings: OrderedDict {name: increasing inner bin edges of mistag probability in (0, 0.5)},
+        see `mistag_percentile_bins` for bins with equal number of events
+    :param int n_bootstrap: number of Poisson bootstrap replicas to estimate error of true mistag, 0 to skip
+    :param random_state: random state for bootstrap
+    
+    :return: OrderedDict {(selection, binning): dict} with keys `edges` (including 0 and 0.5), `centers`,
+        `half_widths`, `right`, `wrong` (sum of weights of right/wrong tagged events), `p_mistag_true`,
+        `p_mistag_true_error` and `p_mistag_true_bootstrap_error` (if n_bootstrap > 0)
+    """
+    Bprobs, Bsign, Bweight = numpy.asarray(Bprobs), numpy.asarray(Bsign), numpy.asarray(Bweight)
+    p_mistag = numpy.minimum(Bprobs, 1 - Bprobs)
+    tag = numpy.where(Bprobs >= 0.5, 1, -1)
+    is_correct = (Bsign * tag > 0) * 1
+
+    # bin index in each binning: number of edges below p_mistag, found via position among all edges
+    binnings = OrderedDict((name, numpy.asarray(edges, dtype=float)) for name, edges in binnings.items())
+    all_edges = numpy.unique(numpy.concatenate(list(binnings.values())))
+    positions = numpy.searchsorted(all_edges, p_mistag)
+    bins_offsets = numpy.cumsum([0] + [len(edges) + 1 for edges in binnings.values()])
+    bins_indices = []
+    for offset, edges in zip(bins_offsets, binnings.values()):
+        lookup = numpy.r_[0, numpy.searchsorted(edges, all_edges, side='right')]
+        bins_indices.append(offset + lookup[positions])
+    n_bins = bins_offsets[-1]
+
+    # events with the same membership in selections are counted together
+    names = list(selections.keys())
+    membership = numpy.zeros(len(Bprobs), dtype=int)
+    for i, name in enumerate(names):
+        membership += numpy.asarray(selections[name], dtype=bool) * 2 ** i
+    patterns, membership = numpy.unique(membership, return_inverse=True)
+    codes = numpy.concatenate([(membership * n_bins + indices) * 2 + is_correct for indices in bins_indices])
+    n_codes = len(patterns) * n_bins * 2
+
+    def count(weight):
+        counts = numpy.bincount(codes, weights=numpy.tile(weight, len(binnings)), minlength=n_codes)
+        counts = counts.reshape(len(patterns), n_bins, 2)
+        # [n_selections, n_bins, (wrong, right)]
+        return numpy.array([counts[(patterns >> i) % 2 == 1].sum(axis=0) for i in range(len(names))])
+
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        counts = count(Bweight)
+        p_mistag_true = counts[:, :, 0] / counts.sum(axis=2)
+        p_mistag_true_error = numpy.sqrt(counts[:, :, 0] * counts[:, :, 1]) / counts.sum(axis=2) ** 1.5
+        bootstrap_error = None
+        if n_bootstrap > 0:
+            random_state = check_random_state(random_state)
+            replicas = []
+            for _ in range(n_bootstrap):
+                replica = count(Bweight * random_state.poisson(1, size=len(Bweight)))
+                replicas.append(replica[:, :, 0] / replica.sum(axis=2))
+            bootstrap_error = numpy.nanstd(replicas, axis=0)
+
+    tables = OrderedDict()
+    for i, selection in enumerate(names):
+        for offset, (binning, edges) in zip(bins_offsets, binnings.items()):
+            part = slice(offset, offset + len(edges) + 1)
+            edges = numpy.r_[0., edges, 0.5]
+            table = {'edges': edges,
+                     'centers': (edges[1:] + edges[:-1]) / 2,
+                     'half_widths': (edges[1:] - edges[:-1]) / 2,
+                     'right': counts[i, part, 1],
+                     'wrong': counts[i, part, 0],
+                     'p_mistag_true': p_mistag_true[i, part],
+                     'p_mistag_true_error': p_mistag_true_error[i, part]}
+            if bootstrap_error is not None:
+                table['p_mistag_true_bootstrap_error'] = bootstrap_error[i, part]
+            tables[(selection, binning)] = table
+    return tables
+
+
+def mistag_percentile_bins(Bprobs, percentiles):
+    """
+    :return: inner bin edges of mistag probability at given percentiles
+    """
+    return numpy.percentile(numpy.minimum(Bprobs, 1 - Bprobs), percentiles)
+
+
+def plot_mistag_table(table, label=""):
+    """
+    Plot true mistag vs mistag probability from one table of `mistag_tables`.
+    """
+    error = table.get('p_mistag_true_bootstrap_error', table['p_mistag_true_error'])
+    plt.errorbar(table['centers'], table['p_mistag_true'], xerr=table['half_widths'], yerr=error, fmt='.', label=label)
+    plt.plot([0, 1], [0, 1], 'k--')
+    plt.xlim(-0.05, 0.55), plt.ylim(-0.05, 0.55)
+    plt.grid()
+
+
 def compute_mistag(Bprobs, Bsign, Bweight, chosen, uniform=True, bins=None, label=""):
     """
     Check mistag calibration (plot mistag vs true mistag in bins)
@@ -544,31 +1243,10 @@ def compute_mistag(Bprobs, Bsign, Bweight, chosen, uniform=True, bins=None, labe
     :params bins: bins
     :param label: label on the plot
     
+    Use `mistag_tables` to compute tables for several selections and binnings at once.
     """
-    if uniform:
-        bins = bins
-    else:
-        bins = numpy.percentile(numpy.minimum(Bprobs, 1 - Bprobs), bins)
-
-    prob = Bprobs[chosen]
-    sign = Bsign[chosen]
-    weight = Bweight[chosen]
-    p_mistag = numpy.minimum(prob, 1 - prob)
-    tag = numpy.where(prob >= 0.5, 1, -1)
-    is_correct = numpy.where(sign * tag > 0, 1, 0)
-    
-    bins_index = numpy.searchsorted(bins, p_mistag)
-    right_tagged = numpy.bincount(bins_index, weights=is_correct * weight)
-    wrong_tagged = numpy.bincount(bins_index, weights=(1 - is_correct) * weight)
-    p_mistag_true = wrong_tagged / (right_tagged + wrong_tagged)
-    
-    bins = [0.] + list(bins) + [0.5]
-    bins = numpy.array(bins)
-    bins_centers = (bins[1:] + bins[:-1]) / 2
-    bins_error = (bins[1:] - bins[:-1]) / 2
-    p_mistag_true_error = numpy.sqrt(wrong_tagged * right_tagged) / (wrong_tagged + right_tagged)**1.5
-    plt.errorbar(bins_centers, p_mistag_true, xerr=bins_error, yerr=p_mistag_true_error, fmt='.', label=label)
-    plt.plot([0, 1], [0, 1], 'k--')
-    plt.xlim(-0.05, 0.55), plt.ylim(-0.05, 0.55)
-    plt.grid()
+    if not uniform:
+        bins = mistag_percentile_bins(Bprobs, bins)
+    tables = mistag_tables(Bprobs, Bsign, Bweight, OrderedDict([('chosen', chosen)]), OrderedDict([('bins', bins)]))
+    plot_mistag_table(tables[('chosen', 'bins')], label=label)
 
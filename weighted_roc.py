@@ -0,0 +1,74 @@
+"""
+Weighted ROC curve and AUC, shared by calibration bootstrap, tagging metrics and early stopping.
+"""
+import numpy
+
+
+class WeightedRoc(object):
+    """
+    Weighted ROC curve and AUC for fixed labels and probabilities: probabilities are sorted only once,
+    then any number of weight vectors (e.g. bootstrap replicates) is evaluated against this order.
+
+    :param labels: numpy.array of shape [n_samples], samples with label > threshold are positive
+    :param probs: numpy.array of shape [n_samples]
+    :param threshold: float, to set labels 0/1
+    :param order: precomputed `numpy.argsort(probs)`, optional
+    """
+    def __init__(self, labels, probs, threshold=0., order=None):
+        probs = numpy.asarray(probs)
+        if order is None:
+            order = numpy.argsort(probs, kind='mergesort')
+        self.order = order
+        self.probs = probs[order]
+        self.positive = numpy.asarray(labels)[order] > threshold
+        # first sample of each group of equal probabilities
+        self.starts = numpy.flatnonzero(numpy.r_[True, self.probs[1:] != self.probs[:-1]])
+        self.thresholds = self.probs[self.starts]
+
+    def _class_weights(self, weights):
+        """
+        :return: positive and negative weight in each group of equal probabilities, shape [..., n_groups]
+        """
+        if weights is None:
+            weights = numpy.ones(len(self.order))
+        weights = numpy.asarray(weights, dtype=float)[..., self.order]
+        positive = numpy.add.reduceat(weights * self.positive, self.starts, axis=-1)
+        negative = numpy.add.reduceat(weights * ~self.positive, self.starts, axis=-1)
+        return positive, negative
+
+    def auc(self, weights=None, extra_positive=0., extra_negative=0., extra_prob=0.5):
+        """
+        Weighted AUC (ties give 1/2), the same as `roc_auc_score`.
+
+        :param weights: numpy.array of shape [n_samples] or [n_weights, n_samples], None for unit weights
+        :param extra_positive: weight of additional positive samples with probability `extra_prob`
+        :param extra_negative: weight of additional negative samples with probability `extra_prob`
+        :param extra_prob: probability of additional samples (e.g. 0.5 for untagged events)
+        :return: float or numpy.array of shape [n_weights]
+        """
+        positive, negative = self._class_weights(weights)
+        negative_below = numpy.cumsum(negative, axis=-1) - negative
+        numerator = numpy.sum(positive * (negative_below + 0.5 * negative), axis=-1)
+        total_positive = numpy.sum(positive, axis=-1) + extra_positive
+        total_negative = numpy.sum(negative, axis=-1) + extra_negative
+        if extra_positive != 0 or extra_negative != 0:
+            below, equal, above = [self.thresholds < extra_prob, self.thresholds == extra_prob,
+                                   self.thresholds > extra_prob]
+            numerator = numerator + \
+                extra_positive * (numpy.sum(negative * below, axis=-1) +
+                                  0.5 * (numpy.sum(negative * equal, axis=-1) + extra_negative)) + \
+                extra_negative * (numpy.sum(positive * above, axis=-1) + 0.5 * numpy.sum(positive * equal, axis=-1))
+        return numerator / (total_positive * total_negative)
+
+    def roc_curve(self, weights=None):
+        """
+        Weighted ROC curve in all distinct thresholds.
+
+        :param weights: numpy.array of shape [n_samples], None for unit weights
+        :return: fpr, tpr, thresholds (decreasing), as `sklearn.metrics.roc_curve`
+        """
+        positive, negative = self._class_weights(weights)
+        tps = numpy.cumsum(positive[::-1])
+        fps = numpy.cumsum(negative[::-1])
+        thresholds = self.thresholds[::-1]
+        return numpy.r_[0., fps / fps[-1]], numpy.r_[0., tps / tps[-1]], numpy.r_[thresholds[0] + 1, thresholds]